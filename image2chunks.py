@@ -25,18 +25,45 @@ import io
 import zlib
 import argparse
 import hashlib
+import time
+import threading
+import random
 from collections import OrderedDict
-from binascii import crc32
+from bisect import bisect_right
+from binascii import crc32, hexlify, unhexlify
 
 # our tools are in "libexec"
 sys.path.append(os.path.join(sys.path[0], "libexec"))
 
 import dz
+import kdz
+import ext4
+import f2fs
+import jobs
+import pzlib
+import copyrange
+import buildcache
 
 # compatibility, Python 3 has SEEK_HOLE/SEEK_DATA, Python 2 does not
 SEEK_HOLE = io.SEEK_HOLE if hasattr(io, "SEEK_HOLE") else 4
 SEEK_DATA = io.SEEK_DATA if hasattr(io, "SEEK_DATA") else 3
 
+# compatibility, zlib's crc32() releases the GIL (allowing parallel
+# checksumming), but under Python 2 it won't accept a bytearray
+try:
+	zcrc32 = zlib.crc32
+	zcrc32(bytearray(1))
+except TypeError:
+	zcrc32 = crc32
+
+# compatibility, Python 2's zlib won't take a memoryview, though it will
+# take a read-only buffer(), which doesn't copy either
+try:
+	zlib.compress(memoryview(b""))
+	pieceView = lambda buf, view, count: view[:count]
+except TypeError:
+	pieceView = lambda buf, view, count: buffer(buf, 0, count)
+
 class EXT4SparseChunk(dz.DZStruct):
 	"""
 	Class for handling chunk from Android sparse image format file
@@ -87,26 +114,50 @@ class EXT4SparseChunk(dz.DZStruct):
 			if self.remaining != values['totalSize'] - len(buf):
 				print("[!] Error encountered raw chunk with incorrect amount of payload", file=sys.stderr)
 				sys.exit(64)
+
+			# where the payload is found, if it can be found again
+			if head.seekable:
+				self.offset = self.pipe.tell()
 		elif self.type == self.typeFill:
 			buf = self.pipe.read(values['totalSize'] - len(buf))
-			self.buffer = b""
-			while len(self.buffer) < readSize:
-				self.buffer += buf
+			self.pattern = buf
+			# once, by multiplication, readSize is a multiple of 4
+			self.buffer = memoryview(buf * (readSize // len(buf)))
+		elif self.type == self.typeCrc32:
+			# the CRC32 isn't of use to us, skip it
+			self.pipe.read(values['totalSize'] - len(buf))
+
+	def readFull(self, view):
+		"""
+		Fill view from the pipe, which may give back less than asked for
+		"""
 
-	def __del__(self):
+		done = 0
+		while done < len(view):
+			count = self.pipe.readinto(view[done:])
+			if not count:
+				print("[!] Error: sparse image data ended early", file=sys.stderr)
+				sys.exit(2)
+			done += count
+
+	def drain(self):
 		"""
-		Destructor for EXT4SparseChunk, notably read remaining data,
-		if any is left behind
+		Skip any of our data which wasn't consumed, must be done before
+		the next chunk header is read
 		"""
 
-		if self.type == self.typeRaw or self.type == self.typeFill:
-			while self.remaining > 0:
-				if self.remaining < (1<<self.blockShift):
-					buf = self.pipe.read(self.remaining)
-				else:
-					buf = self.pipe.read(self.readSize)
-				self.remaining -= len(buf)
-				self.head.crc = crc32(buf, self.head.crc)
+		if self.type != self.typeRaw and self.type != self.typeFill:
+			return
+
+		# a file can skip the payload
+		if self.head.seekable:
+			if self.type == self.typeRaw:
+				self.pipe.seek(self.remaining, io.SEEK_CUR)
+			self.remaining = 0
+			return
+
+		for buf in self:
+			pass
 
 	def __iter__(self):
 		"""
@@ -116,27 +167,27 @@ class EXT4SparseChunk(dz.DZStruct):
 
 	def __next__(self):
 		"""
-		Retrieve the next parsed chunk
+		Retrieve the next piece of our data.  This is a view of a buffer
+		from the pool, valid until EXT4SparseFile.poolSize more pieces
+		have been retrieved.
 		"""
 
 		if self.remaining <= 0:
 			raise StopIteration
 
+		count = min(self.remaining, self.readSize)
+
 		if self.type == self.typeRaw:
-			if self.remaining < self.readSize:
-				buf = self.pipe.read(self.remaining)
-			else:
-				buf = self.pipe.read(self.readSize)
+			buf = self.head.getBuffer()[:count]
+			self.readFull(buf)
 
 		elif self.type == self.typeFill:
-			if self.remaining < self.readSize:
-				buf = self.buffer[:self.readSize]
-			else:
-				buf = self.buffer
+			buf = self.buffer[:count]
 
-		self.remaining -= len(buf)
+		self.remaining -= count
 
-		self.head.crc = crc32(buf, self.head.crc)
+		if self.head.crc != None:
+			self.head.crc = zcrc32(buf, self.head.crc)
 
 		return buf
 
@@ -155,6 +206,10 @@ class EXT4SparseFile(dz.DZStruct):
 	# Header magic number
 	_dz_header = b"\x3A\xFF\x26\xED"
 
+	# Number of buffers data is read into, each piece of a chunk stays
+	# valid until this many more have been read
+	poolSize = 2
+
 	# Format dictionary
 	_dz_format_dict = OrderedDict([
 		('header',	('4s',	False)),	# magic number
@@ -168,63 +223,84 @@ class EXT4SparseFile(dz.DZStruct):
 		('imageCRC32',	('I',	False)),	# CRC32 of image
 	])
 
-	def __init__(self, name, readSize):
+	def __init__(self, name, readSize, file=None):
 		"""
-		Initializer for EXT4SparseHeader, gets DZStruct to fill values
+		Initializer for EXT4SparseHeader, gets DZStruct to fill values.
+		Parses file if given (an existing sparse image, which must be
+		seekable), otherwise the output of ext2simg for name.
 		"""
 		super(EXT4SparseFile, self).__init__(EXT4SparseFile)
 
-		# Invoke ext2simg (really should be ext4tosimg)
-		try:
-			child = subprocess.Popen(["ext2simg", "-c", name, "-"], stdout=subprocess.PIPE)
-		except OSError:
-			print("[!] Failed executing ext2simg, has it been installed?", file=sys.stderr)
-			print("[ ]", file=sys.stderr)
-			print("[ ] Suggested resource: http://www.xda-developers.com/easily-get-binaries-needed-to-work-with-kernels/", file=sys.stderr)
-			if os.name != "nt":
+		self.child = None
+		self.seekable = file != None
+
+		if file != None:
+			self.stream = file
+			source = name
+		else:
+			# Invoke ext2simg (really should be ext4tosimg)
+			try:
+				child = subprocess.Popen(["ext2simg", "-c", name, "-"], stdout=subprocess.PIPE)
+			except OSError:
+				print("[!] Failed executing ext2simg, has it been installed?", file=sys.stderr)
 				print("[ ]", file=sys.stderr)
-				print("[ ] Debian/Linux variants, install the package android-tools-fsutils", file=sys.stderr)
-			sys.exit(1)
+				print("[ ] Suggested resource: http://www.xda-developers.com/easily-get-binaries-needed-to-work-with-kernels/", file=sys.stderr)
+				if os.name != "nt":
+					print("[ ]", file=sys.stderr)
+					print("[ ] Debian/Linux variants, install the package android-tools-fsutils", file=sys.stderr)
+				sys.exit(1)
 
-		self.child = child
+			self.child = child
+			self.stream = io.open(child.stdout.fileno(), "rb", closefd=False)
+			source = "ext2simg"
 
 		self.readSize = readSize
 
+		# Reusable buffers for chunk data
+		self.buffers = [memoryview(bytearray(readSize)) for i in range(self.poolSize)]
+		self.nextBuffer = 0
+		self.last = None
+
 		# grab the header
-		buf = self.child.stdout.read(self._dz_length)
+		buf = self.stream.read(self._dz_length)
 
 		# parse out the values
 		values = self.unpackdict(buf)
 
 		# valid, the format hasn't changed?
 		if values == None:
-			print("[!] Error: Bad sparse-image header from ext2simg! (newer format, other?)", file=sys.stderr)
+			print("[!] Error: Bad sparse-image header from {:s}! (newer format, other?)".format(source), file=sys.stderr)
 			sys.exit(1)
 
 		# Newer format, fail if not known
 		if values['major'] != 1:
-			print("[!] Error: Output format from ext2simg too recent, unable to parse, failed", file=sys.stderr)
+			print("[!] Error: Sparse format from {:s} too recent, unable to parse, failed".format(source), file=sys.stderr)
 			sys.exit(1)
 
 		# Newer format, but not incompatible
 		if values['minor'] > 0:
-			print("[!] Warning: Output format from ext2simg more recent than this utility", file=sys.stderr)
+			print("[!] Warning: Sparse format from {:s} more recent than this utility".format(source), file=sys.stderr)
 
 		# Extra fields to ignore
 		if values['headerSize'] > self._dz_length:
-			self.child.stdout.read(values['headerSize'] - self._dz_length)
+			self.stream.read(values['headerSize'] - self._dz_length)
 
 		# How large the chunks are
 		self.chunkHSize = values['chunkHSize']
 		self.chunkCount = values['totalChunks']
 
-		# CRC32 of image
+		# CRC32 of image, not checked when the payload is skipped
 		self.origCrc = values['imageCRC32']
-		self.crc = crc32(b"")
+		self.crc = zcrc32(b"") if not self.seekable else None
 
 		# Block size of the device, power of 2, minimum of 4K
 		size = values['blockSize']
 		self.blockSize = size
+		self.size = values['totalBlocks'] * size
+
+		# Where the chunks of the image are found, when parsing a file
+		self.position = 0
+		self.segments = []
 
 		if size & (size-1):
 			print("[!] Error: Block size specified in sparse header is not a power of 2", file=sys.stderr)
@@ -239,6 +315,14 @@ class EXT4SparseFile(dz.DZStruct):
 			shift>>=1
 		self.blockShift = result
 
+	def getBuffer(self):
+		"""
+		Return the next buffer from the pool
+		"""
+		buf = self.buffers[self.nextBuffer]
+		self.nextBuffer = (self.nextBuffer + 1) % self.poolSize
+		return buf
+
 	def __del__(self):
 		"""
 		Destructor for Image2Chunks, notably kills child if needed
@@ -277,17 +361,15 @@ class EXT4SparseFile(dz.DZStruct):
 		Retrieve the next parsed chunk
 		"""
 
-		try:
-			# The previous chunk object *MUST* be destroyed *NOW*
-			self.last.__del__()
-		except AttributeError:
-			# doesn't exist yet
-			pass
+		# The previous chunk *MUST* be finished with *NOW*
+		if self.last:
+			self.last.drain()
 
 		if self.chunkCount <= 0:
-			self.crc = self.crc & 0xFFFFFFFF
+			if self.crc != None:
+				self.crc = self.crc & 0xFFFFFFFF
 			# apparently 0 is used for none computed
-			if self.crc != self.origCrc and self.origCrc != 0:
+			if self.crc != None and self.crc != self.origCrc and self.origCrc != 0:
 				print("[!] CRC mismatch, computed={:08X}, original={:08X}".format(self.crc, self.origCrc))
 				sys.exit(4)
 
@@ -295,24 +377,411 @@ class EXT4SparseFile(dz.DZStruct):
 
 		self.chunkCount -= 1
 
-		buf = self.child.stdout.read(self.chunkHSize)
+		buf = self.stream.read(self.chunkHSize)
 
 		if len(buf) != self.chunkHSize:
 			print("[!] Attempting to read chunk header got short read", file=sys.stderr)
 			sys.exit(2)
 
-		self.last = EXT4SparseChunk(self, buf, self.child.stdout, self.blockShift, self.readSize)
+		self.last = EXT4SparseChunk(self, buf, self.stream, self.blockShift, self.readSize)
+
+		if self.seekable:
+			if self.last.type == EXT4SparseChunk.typeRaw:
+				self.segments.append((self.position, self.last.remaining, self.last.offset, None))
+			elif self.last.type == EXT4SparseChunk.typeFill:
+				self.segments.append((self.position, self.last.remaining, None, self.last.pattern))
+			self.position += self.last.remaining
+
 		return self.last
 
 	# Python 2 compatibility
 	next = __next__
 
 
+class EXT4SparseReader(object):
+	"""
+	Read-only file-like view of the image within an Android sparse image
+	file, using the chunk locations found by EXT4SparseFile
+	"""
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		"""
+		Move to offset within the image
+		"""
+		if whence == io.SEEK_CUR:
+			offset += self.pos
+		elif whence == io.SEEK_END:
+			offset += self.size
+		self.pos = offset
+		return offset
+
+	def tell(self):
+		"""
+		Return our position within the image
+		"""
+		return self.pos
+
+	def read(self, size):
+		"""
+		Read up to size bytes of the image
+		"""
+
+		out = []
+		end = min(self.pos + size, self.size)
+		idx = bisect_right(self.starts, self.pos) - 1
+
+		while self.pos < end:
+			if idx >= 0:
+				start, length, offset, pattern = self.segments[idx]
+
+			# DONT_CARE, reads as zeros
+			if idx < 0 or self.pos >= start + length:
+				next = self.starts[idx + 1] if idx + 1 < len(self.starts) else self.size
+				count = min(next, end) - self.pos
+				out.append(bytes(bytearray(count)))
+				idx += 1
+
+			elif offset != None:
+				count = min(start + length, end) - self.pos
+				self.file.seek(offset + self.pos - start, io.SEEK_SET)
+				buf = self.file.read(count)
+				if len(buf) != count:
+					print("[!] Error: {:s} is truncated".format(self.file.name), file=sys.stderr)
+					sys.exit(1)
+				out.append(buf)
+
+			else:
+				count = min(start + length, end) - self.pos
+				phase = (self.pos - start) % len(pattern)
+				out.append((pattern * ((phase + count) // len(pattern) + 1))[phase:phase + count])
+
+			self.pos += count
+
+		return b"".join(out)
+
+	def readinto(self, view):
+		"""
+		Read into view, returns the number of bytes read
+		"""
+		buf = self.read(len(view))
+		view[:len(buf)] = buf
+		return len(buf)
+
+	def close(self):
+		"""
+		Close the sparse image file
+		"""
+		self.file.close()
+
+	def __init__(self, name, segments, size):
+		"""
+		Initializer for EXT4SparseReader, segments are as found by
+		EXT4SparseFile, size is the length of the image
+		"""
+
+		super(EXT4SparseReader, self).__init__()
+
+		self.file = io.FileIO(name, "rb")
+		self.segments = segments
+		self.starts = [seg[0] for seg in segments]
+		self.size = size
+		self.pos = 0
+
+
+class BlockReader(object):
+	"""
+	Sequential reader of an area of a file.  Large readinto() calls (of
+	readSize, from block-aligned offsets) fill recycled buffers and views
+	of the data are handed out, each valid until poolSize more have been.
+	Hashers and compressors take the views directly, without copies.
+	"""
+
+	# Number of buffers to cycle through
+	poolSize = 2
+
+	# Zero-filled blocks are looked for where this many zeros are found,
+	# searching for a whole block's worth is slower
+	zeroRun = bytes(bytearray(64))
+
+	def isZero(self, offset=0, length=None):
+		"""
+		Is the latest piece (or length bytes of it from offset) all zero?
+		"""
+
+		if length == None:
+			length = self.count - offset
+
+		if len(self.zeros) < length:
+			self.zeros = memoryview(bytes(bytearray(length)))
+
+		return self.current.startswith(self.zeros[:length], offset)
+
+	def spans(self, blockSize):
+		"""
+		Yield (offset, length, zero) for the runs of zero-filled and
+		other blocks of the latest piece.  Zero runs are measured by
+		comparing ever larger ranges at once, then narrowing down to the
+		block where they end, other runs by searching for the next few
+		zeros which could start a zero-filled block.  Only the blocks
+		where the kind changes are looked at individually.
+		"""
+
+		count = self.count
+		zeroRun = self.zeroRun[:blockSize]
+
+		pos = 0
+		while pos < count:
+			# zero blocks, doubling the range until it isn't all zero,
+			# then halving it to find the block which isn't
+			stop = pos
+			step = blockSize
+			while stop < count and self.isZero(stop, min(step, count - stop)):
+				stop += step
+				step = stop - pos
+			while stop < count and step > blockSize:
+				step >>= 1
+				if self.isZero(stop, min(step, count - stop)):
+					stop += step
+
+			stop = min(stop, count)
+			if stop > pos:
+				yield (pos, stop - pos, True)
+				pos = stop
+			if pos >= count:
+				break
+
+			# other blocks, up to the next zero-filled one
+			stop = pos + blockSize
+			while stop < count:
+				hole = self.current.find(zeroRun, stop, count)
+				if hole < 0:
+					# a short block at the end may be zero-filled
+					tail = count & ~(blockSize - 1)
+					stop = tail if tail > pos and tail < count and self.isZero(tail) else count
+					break
+
+				stop = (hole + blockSize - 1) & ~(blockSize - 1)
+				if stop >= count or self.isZero(stop, min(blockSize, count - stop)):
+					break
+
+				# not all of that block, look beyond it
+				stop += 1
+
+			stop = min(stop, count)
+			yield (pos, stop - pos, False)
+			pos = stop
+
+	def __iter__(self):
+		"""
+		Yield the pieces of our area, self.offset is where the latest
+		piece came from.  An empty area is a single empty piece, so there
+		is always at least one.
+		"""
+
+		pos = self.start
+		end = self.start + self.length if self.length != None else None
+		idx = 0
+
+		if self.length == 0:
+			buf, view = self.pool[idx]
+			self.current = buf
+			self.count = 0
+			self.offset = pos
+			yield pieceView(buf, view, 0)
+			return
+
+		self.file.seek(pos, io.SEEK_SET)
+
+		while end == None or pos < end:
+			want = self.readSize if end == None else min(self.readSize, end - pos)
+			buf, view = self.pool[idx]
+
+			count = 0
+			while count < want:
+				got = self.file.readinto(view[count:want])
+				if not got:
+					break
+				count += got
+
+			if count < want and end != None:
+				print("[!] Error: {:s} is shorter than expected".format(self.name), file=sys.stderr)
+				sys.exit(1)
+
+			if count == 0:
+				break
+
+			self.current = buf
+			self.count = count
+			self.offset = pos
+			yield pieceView(buf, view, count)
+
+			pos += count
+			idx = (idx + 1) % self.poolSize
+
+			if count < want:
+				break
+
+	def __init__(self, file, start, length, readSize, name):
+		"""
+		Initializer for BlockReader, reads length bytes of file from
+		start (to EOF if length is None), name is used for errors
+		"""
+
+		super(BlockReader, self).__init__()
+
+		self.file = file
+		self.start = start
+		self.length = length
+		self.readSize = readSize
+		self.name = name
+
+		# small areas don't need full size buffers
+		size = min(readSize, length) if length != None else readSize
+
+		self.pool = []
+		for i in range(self.poolSize):
+			buf = bytearray(size)
+			self.pool.append((buf, memoryview(buf)))
+
+		self.zeros = memoryview(b"")
+		self.current = None
+		self.count = 0
+		self.offset = start
+
+
+class ReferenceDZ(dz.DZFile):
+	"""
+	Index of the chunks of an existing DZ file (or the DZ file within a
+	KDZ file), so unchanged chunks can be copied instead of compressed
+	"""
+
+	def find(self, dev, targetAddr, targetSize):
+		"""
+		Return the headers of the chunks covering the same area
+		"""
+		return self.index.get((dev, targetAddr, targetSize), [])
+
+	def __init__(self, name):
+		"""
+		Initializer for ReferenceDZ, loads the chunk headers of name
+		"""
+
+		super(ReferenceDZ, self).__init__()
+
+		self.name = os.path.abspath(name)
+
+		try:
+			file = io.open(name, "rb")
+		except IOError as err:
+			print(err, file=sys.stderr)
+			sys.exit(1)
+
+		start = 0
+		end = file.seek(0, io.SEEK_END)
+
+		# locate the DZ file within a KDZ file
+		container = kdz.KDZFile()
+		container.infile = file
+		part = container.findDZ()
+		if part:
+			start = part['offset']
+			end = start + part['length']
+
+		file.seek(start, io.SEEK_SET)
+		if self.unpackdict(file.read(self._dz_length)) == None:
+			print("[!] Error: {:s} isn't a DZ file".format(name), file=sys.stderr)
+			sys.exit(1)
+
+		chunk = dz.DZChunk()
+		self.index = {}
+		pos = start + self._dz_length
+		count = 0
+
+		while pos + chunk._dz_length <= end:
+			file.seek(pos, io.SEEK_SET)
+			values = chunk.unpackdict(file.read(chunk._dz_length))
+			if values == None:
+				print("[!] Error: bad chunk header in {:s} (offset {:d})".format(name, pos), file=sys.stderr)
+				sys.exit(1)
+
+			values['dataOffset'] = pos + chunk._dz_length
+			key = (values['dev'], values['targetAddr'], values['targetSize'])
+			self.index.setdefault(key, []).append(values)
+
+			pos = values['dataOffset'] + values['dataSize']
+			count += 1
+
+		file.close()
+
+		print("[+] Loaded {:d} chunk headers from reference {:s}".format(count, name))
+
+
+
 class Image2Chunks(dz.DZChunk):
 	"""
 	Class for transforming a single file from a raw image into chunk files
 	"""
 
+	# Size of reads when compressing
+	readSize = 1<<20
+
+	# Block size for split deflate
+	splitSize = 1<<20
+
+	# Shortest run of zero blocks probing will turn into a hole, less
+	# costs more in chunk headers than it saves
+	probeHole = 64
+
+	# Amount of each chunk compressed to estimate how well it will
+	# compress, in how many pieces spread across it, and the ratio above
+	# which it is stored uncompressed
+	sampleSize = 1<<18
+	samplePieces = 4
+	incompressible = 0.95
+
+	# Number of samples tried at each level when choosing one
+	benchSamples = 4
+
+	# Rough memory needed by a deflate stream, for the budget
+	zlibMemory = 1<<19
+
+	# A dry run compresses about one in this many samples of each chunk
+	estimateFraction = 32
+
+	# Results of a dry run, (chunk name, size, compressed size, seconds)
+	estimates = ()
+	planTime = 0.0
+
+	# The plan, kept when only planning
+	plan = ()
+
+	# Locations of the chunks, if our image is an Android sparse image
+	segments = None
+
+	# Signatures looked for by the automatic strategy
+	#   offset is where the magic number is found in the image
+	#   kind is "ext4", "f2fs" or "blob" (contents we've no map of)
+	# Example:
+	#   (offset, magic, kind, description)
+	sniffMagic = [
+		(ext4.EXT4FS._sb_offset + 0x38,	b"\x53\xEF",		"ext4",	"EXT2/3/4 filesystem"),
+		(0x400,		b"\x10\x20\xF5\xF2",	"f2fs",	"F2FS filesystem"),
+		(0,		b"ANDROID!",		"blob",	"Android boot image"),
+		(0,		b"\x7FELF",		"blob",	"ELF firmware"),
+		(0,		b"hsqs",		"blob",	"SquashFS filesystem"),
+		(0x200,		b"EFI PART",		"blob",	"GUID partition table"),
+		(0x1000,	b"EFI PART",		"blob",	"GUID partition table"),
+		(0x1FE,		b"\x55\xAA",		"blob",	"FAT filesystem or MBR"),
+	]
+
+	def isSparse(self):
+		"""
+		Is our image an Android sparse image?
+		"""
+		self.file.seek(0, io.SEEK_SET)
+		magic = EXT4SparseFile._dz_header
+		return self.file.read(len(magic)) == magic
+
 	def openFiles(self, name):
 		"""
 		Opens the files, provide an error message if one doesn't exist
@@ -357,6 +826,8 @@ class Image2Chunks(dz.DZChunk):
 		self.paramsFile.close()
 		del self.paramsFile
 
+		self.params = params
+
 		if 'phantom' in params and params['phantom']:
 			print("[!] {:s} is a phantom slice, skipping!".format(name))
 			return False
@@ -376,20 +847,73 @@ class Image2Chunks(dz.DZChunk):
 		return True
 
 
-	def makeChunksHoles(self, name):
+	def sniff(self):
 		"""
-		Generate one or more .chunks files for the named file
+		Identify the contents of our image from sniffMagic, returns the
+		kind and description, ("blob", "unrecognized data") if nothing
+		matches
 		"""
 
-		os.chdir(os.path.dirname(name))
-		name = os.path.basename(name)
-		baseName = name.rpartition(".")[0] + "_"
-		sliceName = name.rpartition(".")[0].encode("utf8")
+		self.file.seek(0, io.SEEK_SET)
+		head = self.file.read(max(offset + len(magic) for offset, magic, kind, desc in self.sniffMagic))
+
+		for offset, magic, kind, desc in self.sniffMagic:
+			if head[offset:offset + len(magic)] == magic:
+				return (kind, desc)
+
+		return ("blob", "unrecognized data")
 
+
+	def holesUsable(self):
+		"""
+		Will SEEK_DATA/SEEK_HOLE find anything in our image?  The OS and
+		the filesystem underneath need to support them (without support
+		the whole file is data) and the image needs to have holes.
+		"""
+
+		try:
+			return self.file.seek(0, SEEK_HOLE) < os.fstat(self.file.fileno()).st_size
+		except (IOError, OSError):
+			return False
+
+
+	def chooseStrategy(self, name):
+		"""
+		Pick the fastest safe strategy for the named image from its
+		contents, the choice and how long it took are reported
+		"""
+
+		begin = time.time()
+
+		kind, desc = self.sniff()
+
+		if kind == "ext4":
+			strategy = self.planEXT4Auto
+			how = "using the block bitmaps"
+		elif kind == "f2fs":
+			strategy = self.planF2FS
+			how = "using the segment information table"
+		elif self.holesUsable():
+			strategy = self.planHoles
+			how = "using SEEK_DATA/SEEK_HOLE"
+		else:
+			strategy = self.planProbe
+			how = "probing for holes"
+
+		print("[+] {:s} is {:s}, {:s} (decided in {:.1f}ms)".format(name, desc, how, (time.time() - begin) * 1000))
+
+		return strategy
+
+
+	def planHoles(self):
+		"""
+		Plan the chunks for our image using SEEK_DATA/SEEK_HOLE
+		"""
+
+		plan = []
 		current = 0
 		targetAddr = self.startLBA
 		eof = self.file.seek(0, io.SEEK_END)
-		self.file.seek(0, io.SEEK_SET)
 
 		while current < eof:
 			hole = (self.file.seek(current, SEEK_HOLE) + self.blockSize-1) & ~(self.blockSize-1)
@@ -401,158 +925,150 @@ class Image2Chunks(dz.DZChunk):
 				next = eof
 				trimCount = self.lastWipe - targetAddr
 
-			# Watch out for chunks >4GB (too big!)
-			# Also, try not to test the limits of LG's tools...
-			if (hole - current) >= 1<<27:
-				hole = current + (1<<27)
-				next = hole
-				trimCount = (next - current) >> self.blockShift
+			plan.append((current, hole - current, trimCount))
 
-			md5 = hashlib.md5()
-			crc = crc32(b"")
-			zobj = zlib.compressobj(1)
-			self.file.seek(current, io.SEEK_SET)
+			current = next
+			targetAddr = self.startLBA + (current >> self.blockShift)
 
-			chunkName = baseName + str(targetAddr) + ".bin"
-			out = io.FileIO(chunkName + ".chunk", "wb")
+		return plan
 
-			print("[+] Compressing {:s} to {:s} ({:d} empty blocks)".format(name, chunkName, (next - hole) >> self.blockShift))
 
-			chunkName = chunkName.encode("utf8")
-			out.seek(self._dz_length, io.SEEK_SET)
-			zlen = 0
+	def planEXT4FS(self):
+		"""
+		Plan the chunks for our image from the block bitmaps of the
+		EXT2/3/4 filesystem within, ext2simg is used if it can't be read
+		"""
 
-			for b in range((hole - current) >> self.blockShift):
-				buf = self.file.read(self.blockSize)
-				md5.update(buf)
-				crc = crc32(buf, crc)
-				zdata = zobj.compress(buf)
-				zlen += len(zdata)
-				out.write(zdata)
+		try:
+			fs = ext4.EXT4FS(self.file)
+		except ext4.NoEXT4 as err:
+			print("[!] {:s}: {:s}, trying ext2simg".format(self.fileName, str(err)), file=sys.stderr)
+			return self.planEXT4Sparse()
 
-			zdata = zobj.flush(zlib.Z_FINISH)
-			zlen += len(zdata)
-			out.write(zdata)
-			md5 = md5.digest()
+		return self.planRuns(fs.usedRuns())
 
 
-			out.seek(0, io.SEEK_SET)
+	def planEXT4Auto(self):
+		"""
+		Plan the chunks for our image from the block bitmaps like
+		planEXT4FS(), for --auto, if they can't be read the image is
+		treated as unknown instead of relying on ext2simg
+		"""
 
-			values = {
-				'sliceName':	sliceName,
-				'chunkName':	chunkName,
-				'targetSize':	hole - current,
-				'dataSize':	zlen,
-				'md5':		md5,
-				'targetAddr':	targetAddr,
-				'trimCount':	trimCount,
-				'crc32':	crc & 0xFFFFFFFF,
-				'dev':		self.dev,
-			}
-
-			header = self.packdict(values)
-			out.write(header)
-			out.close()
+		try:
+			fs = ext4.EXT4FS(self.file)
+			return self.planRuns(fs.usedRuns())
+		except ext4.NoEXT4 as err:
+			if self.holesUsable():
+				print("[!] {:s}: {:s}, using SEEK_DATA/SEEK_HOLE instead".format(self.fileName, str(err)), file=sys.stderr)
+				return self.planHoles()
+			print("[!] {:s}: {:s}, probing instead".format(self.fileName, str(err)), file=sys.stderr)
+			return self.planProbe()
 
-			current = next
-			targetAddr = self.startLBA + (current >> self.blockShift)
 
-		print("[+] done\n")
+	def planF2FS(self):
+		"""
+		Plan the chunks for our image from the checkpoint and segment
+		information table of the F2FS filesystem within, probing is used
+		if it can't be read
+		"""
+
+		try:
+			fs = f2fs.F2FS(self.file)
+			return self.planRuns(fs.usedRuns())
+		except f2fs.NoF2FS as err:
+			print("[!] {:s}: {:s}, probing instead".format(self.fileName, str(err)), file=sys.stderr)
+			return self.planProbe()
 
 
-	def makeChunksEXT4FS(self, name):
+	def planRuns(self, used):
 		"""
-		Generate one or more .chunks files assuming an EXT4 FS
+		Turn the (offset, length) areas a filesystem has in use into our
+		plan, everything between is trimmed
 		"""
 
-		os.chdir(os.path.dirname(name))
-		name = os.path.basename(name)
-		baseName = name.rpartition(".")[0] + "_"
-		sliceName = name.rpartition(".")[0].encode("utf8")
+		# filesystem blocks may be smaller than ours
+		runs = []
+		for start, length in used:
+			end = (start + length + self.blockSize - 1) & ~(self.blockSize - 1)
+			start &= ~(self.blockSize - 1)
+			if runs and start <= runs[-1][1]:
+				runs[-1][1] = end
+			else:
+				runs.append([start, end])
 
-		# Check length before closing
-		eof = self.file.seek(0, io.SEEK_END)
+		plan = []
+		for idx in range(len(runs)):
+			start, end = runs[idx]
 
-		# Alas, ext2simg can't take the image as stdin
-		self.file.close()
+			# last one, lastWipe overrides
+			if idx + 1 < len(runs):
+				trimCount = (runs[idx + 1][0] - start) >> self.blockShift
+			else:
+				trimCount = self.lastWipe - self.startLBA - (start >> self.blockShift)
 
-		sparse = EXT4SparseFile(name, 1<<self.blockShift)
+			plan.append((start, end - start, trimCount))
 
-		# sigh, Python 2 hack for some variables
-		class nl:
-			yuck = "truly"
+		return plan
 
-		nl.current = 0
-		nl.targetAddr = self.startLBA
-		nl.trimCount = 0
 
-		# local function not used by anyone else
-		def complete():
-#			nonlocal zlen, md5, current, targetAddr, trimCount
-			zdata = zobj.flush(zlib.Z_FINISH)
-			nl.zlen += len(zdata)
-			out.write(zdata)
-			nl.md5 = nl.md5.digest()
+	def planSparse(self):
+		"""
+		Plan the chunks for our image, which is an Android sparse image,
+		its chunks map straight to ours
+		"""
 
-			out.seek(0, io.SEEK_SET)
+		self.file.seek(0, io.SEEK_SET)
+		sparse = EXT4SparseFile(self.imageName, self.readSize, self.file)
+		plan = self.planEXT4Sparse(sparse)
 
-			values = {
-				'sliceName':	sliceName,
-				'chunkName':	chunkName,
-				'targetSize':	dataBlocks << self.blockShift,
-				'dataSize':	nl.zlen,
-				'md5':		nl.md5,
-				'targetAddr':	nl.targetAddr,
-				'trimCount':	nl.trimCount,
-				'crc32':	crc & 0xFFFFFFFF,
-				'dev':		self.dev,
-			}
+		self.segments = sparse.segments
+		self.imageSize = sparse.size
 
-			nl.header = self.packdict(values)
-			out.write(nl.header)
-			out.close()
+		return plan
 
-			nl.current += nl.trimCount << self.blockShift
-			nl.targetAddr = self.startLBA + (nl.current >> self.blockShift)
 
-			print("({:d} empty blocks)".format(nl.trimCount - dataBlocks))
+	def planEXT4Sparse(self, sparse=None):
+		"""
+		Plan the chunks for our image using ext2simg's output (or sparse)
+		"""
 
-			nl.trimCount = 0
+		if sparse == None:
+			sparse = EXT4SparseFile(self.imageName, self.readSize)
+
+		plan = []
+		current = 0
+		trimCount = 0
+		dataBlocks = 0
 
 		for chunk in sparse:
 			if chunk.type == EXT4SparseChunk.typeRaw or chunk.type == EXT4SparseChunk.typeFill:
-				if nl.trimCount:
-					complete()
-				dataBlocks = chunk.remaining >> self.blockShift
-				nl.trimCount += dataBlocks
-
-				nl.md5 = hashlib.md5()
-				crc = crc32(b"")
-				zobj = zlib.compressobj(1)
-
-				chunkName = baseName + str(nl.targetAddr) + ".bin"
-				out = io.FileIO(chunkName + ".chunk", "wb")
+				if trimCount:
+					plan.append((current, dataBlocks << self.blockShift, trimCount))
+					current += trimCount << self.blockShift
+					trimCount = 0
 
-				sys.stdout.write("[+] Compressing {:s} to {:s} ".format(name, chunkName))
-
-				chunkName = chunkName.encode("utf8")
-				out.seek(self._dz_length, io.SEEK_SET)
-				nl.zlen = 0
+				dataBlocks = chunk.remaining >> self.blockShift
+				trimCount += dataBlocks
 
-				for buf in chunk:
-					nl.md5.update(buf)
-					crc = crc32(buf, crc)
-					zdata = zobj.compress(buf)
-					nl.zlen += len(zdata)
-					out.write(zdata)
+				# the data is read from the image itself, it is simply
+				# drained when the next chunk is retrieved
 
 			elif chunk.type == EXT4SparseChunk.typeDontCare:
+				# nothing to wipe in front of, simply skip it
+				if not trimCount:
+					current += chunk.remaining
+					continue
+
 				# check for EOF, lastWipe overrides
 				if sparse.chunkCount == 0:
-					nl.trimCount = self.lastWipe - nl.targetAddr
+					trimCount = self.lastWipe - self.startLBA - (current >> self.blockShift)
 				else:
-					nl.trimCount += chunk.remaining>>self.blockShift
-				complete()
+					trimCount += chunk.remaining>>self.blockShift
+
+				plan.append((current, dataBlocks << self.blockShift, trimCount))
+				current += trimCount << self.blockShift
+				trimCount = 0
 
 			elif chunk.type == EXT4SparseChunk.typeCrc32:
 				pass
@@ -560,171 +1076,673 @@ class Image2Chunks(dz.DZChunk):
 				print("[!] Error: unknown chunk, type=0x{:04X}".format(chunk.type), file=sys.stderr)
 				sys.exit(64)
 
-		if nl.trimCount:
-			nl.trimCount = self.lastWipe - nl.targetAddr
-			complete()
+		if trimCount:
+			trimCount = self.lastWipe - self.startLBA - (current >> self.blockShift)
+			plan.append((current, dataBlocks << self.blockShift, trimCount))
 
-		print("[+] done\n")
+		return plan
 
 
-	def makeChunksProbe(self, name):
+	def zeroRuns(self):
 		"""
-		Generate one or more .chunks files for the named file
+		Scan our image for zero-filled blocks, yields (offset, length,
+		zero) for each run of blocks of the same kind.  The pieces read
+		are scanned in place, see BlockReader.spans().
 		"""
 
-		os.chdir(os.path.dirname(name))
-		name = os.path.basename(name)
-		baseName = name.rpartition(".")[0] + "_"
-		sliceName = name.rpartition(".")[0].encode("utf8")
+		reader = BlockReader(self.file, 0, None, self.blockSize << 10, self.fileName)
 
-		current = 0
-		targetAddr = self.startLBA
-		eof = self.file.seek(0, io.SEEK_END)
-		self.file.seek(0, io.SEEK_SET)
+		runStart = 0
+		runZero = None
+		end = 0
 
+		for view in reader:
+			offset = reader.offset
+			count = len(view)
+			end = offset + count
 
+			for pos, length, zero in reader.spans(self.blockSize):
+				if zero != runZero:
+					if runZero != None:
+						yield (runStart, offset + pos - runStart, runZero)
+					runStart = offset + pos
+					runZero = zero
 
-# emulate characteristics of LG's tool, always find a block at start
-		readSize = self.blockSize << 10
+		if runZero != None:
+			yield (runStart, end - runStart, runZero)
 
-		md5 = hashlib.md5()
-		crc = crc32(b"")
-		zobj = zlib.compressobj(1)
-		self.file.seek(current, io.SEEK_SET)
 
-		chunkName = baseName + str(targetAddr) + ".bin"
-		out = io.FileIO(chunkName + ".chunk", "wb")
+	def planProbe(self):
+		"""
+		Plan the chunks for our image by probing for zero-filled blocks
+		"""
+
+		plan = []
+		start = 0
+		dataEnd = None
+		end = 0
 
-		sys.stdout.write("[+] Compressing {:s} to {:s} ".format(name, chunkName))
+		for offset, length, zero in self.zeroRuns():
+			end = offset + length
 
-		chunkName = chunkName.encode("utf8")
-		out.seek(self._dz_length, io.SEEK_SET)
-		zlen = 0
+			# emulate characteristics of LG's tool, always find a block at
+			# start, so leading zeros become data
+			if zero:
+				continue
+
+			if dataEnd != None and offset - dataEnd >= self.probeHole << self.blockShift:
+				plan.append((start, dataEnd - start, (offset - start) >> self.blockShift))
+				start = offset
+
+			dataEnd = end
+
+		# entirely zeros, the whole thing is data
+		if dataEnd == None:
+			dataEnd = end
+
+		# last one, lastWipe overrides
+		plan.append((start, dataEnd - start, self.lastWipe - self.startLBA - (start >> self.blockShift)))
 
-		wipeData = readSize
-		dataCount = readSize
+		return plan
+
+
+	def limitPlan(self, plan):
+		"""
+		Watch out for chunks >4GB (too big!), also try not to test the
+		limits of LG's tools...  Split data runs into 128MB pieces.
+		"""
+
+		limit = 1<<27
+		out = []
+
+		for start, length, trimCount in plan:
+			while length > limit:
+				out.append((start, limit, limit >> self.blockShift))
+				start += limit
+				length -= limit
+				trimCount -= limit >> self.blockShift
+			out.append((start, length, trimCount))
+
+		return out
+
+
+	def openImage(self):
+		"""
+		Return our own handle on the image, so jobs don't fight over the
+		position
+		"""
 
+		if self.segments != None:
+			return EXT4SparseReader(self.imageName, self.segments, self.imageSize)
 
+		return io.FileIO(self.imageName, "rb")
+
+
+	def chooseLevel(self, plan):
+		"""
+		Pick the compression level for our image according to the policy,
+		either a level, "fastest", "smallest" or "time:SECONDS" (the
+		smallest result expected to take no longer).  For the latter two
+		each level is tried on samples from across the image.
+		"""
+
+		if self.policy.isdigit():
+			return int(self.policy)
+		elif self.policy == "fastest":
+			return 1
+
+		total = sum(length for start, length, trimCount in plan)
+		if total == 0:
+			return 1
+
+		# samples spread evenly through the data
+		file = self.openImage()
+		sample = []
+		count = min(self.benchSamples, (total + self.sampleSize - 1) // self.sampleSize)
+		for idx in range(count):
+			want = total * idx // count
+			for start, length, trimCount in plan:
+				if want < length:
+					file.seek(start + want, io.SEEK_SET)
+					sample.append(file.read(min(self.sampleSize, length - want)))
+					break
+				want -= length
+		file.close()
+		sample = b"".join(sample)
+
+		results = []
+		for level in range(1, 10):
+			begin = time.time()
+			size = len(zlib.compress(sample, level))
+			results.append((size, level, time.time() - begin))
+
+		if self.policy == "smallest":
+			level = min(results)[1]
+		else:
+			budget = float(self.policy[5:])
+			# the chunks are compressed by several workers at once
+			scale = float(total) / len(sample) / max(self.jobs, 1)
+			fits = [(size, level) for size, level, elapsed in results if elapsed * scale <= budget]
+			level = min(fits)[1] if fits else 1
+
+		size = [size for size, lvl, elapsed in results if lvl == level][0]
+		print("[+] Using compression level {:d} for {:s} (policy {:s}, sample ~{:d}%)".format(level, self.fileName, self.policy, int(size * 100.0 / len(sample) + 0.5)))
+
+		return level
+
+
+	def makeChunk(self, item):
+		"""
+		Compress one planned chunk of our image, once the budget shared
+		with the other images allows, unless an interrupted run already
+		finished it
+		"""
+
+		name = self.resumeChunk(item)
+		if name:
+			return name
+
+		start, length, trimCount = item
+
+		# split mode works on a chunk with all the workers
+		if self.split and length >= self.splitSize << 1:
+			cpus = self.jobs
+			memory = self.splitSize * self.jobs * 2 + self.zlibMemory * self.jobs
+		else:
+			cpus = 1
+			memory = self.zlibMemory
+		memory += self.readSize * BlockReader.poolSize
+
+		with self.budget.reserve(cpus, memory):
+			name = self.compressChunk(item)
+
+		self.journalChunk(item, name)
+
+		return name
+
+
+	def compressChunk(self, item):
+		"""
+		Compress one planned chunk of our image into its .chunk file
+		"""
+
+		targetAddr = self.startLBA + (item[0] >> self.blockShift)
+		chunkName = self.baseName + str(targetAddr) + ".bin"
+
+		out = io.FileIO(os.path.join(self.dirName, chunkName + ".chunk"), "wb")
+		self.writeChunk(item, out, 0)
+		out.close()
+
+		return chunkName + ".chunk"
+
+
+	def chunkLevel(self, file, start, length):
+		"""
+		Decide whether the chunk at start is deflated or stored, from
+		samples spread across it, returns the level and the ratio
+		expected at it.  Deflating what won't shrink is wasted effort,
+		stored blocks are still a valid zlib stream.
+		"""
+
+		piece = self.sampleSize // self.samplePieces
+		count = min(self.samplePieces, (length + piece - 1) // piece)
+
+		samples = []
+		for idx in range(count):
+			offset = start
+			if count > 1:
+				offset += (length - piece) * idx // (count - 1) & ~(self.blockSize - 1)
+			file.seek(offset, io.SEEK_SET)
+			samples.append(file.read(min(piece, start + length - offset)))
+
+		# a chunk which is all hole has nothing to sample
+		size = sum(len(sample) for sample in samples)
+		if size == 0:
+			return (self.level, 0.0)
+
+		ratio = sum(len(zlib.compress(sample, self.level)) for sample in samples) / float(size)
+		if ratio <= self.incompressible:
+			return (self.level, ratio)
+
+		return (0, sum(len(zlib.compress(sample, 0)) for sample in samples) / float(size))
+
+
+	def writeChunk(self, item, out, base):
+		"""
+		Write one planned chunk of our image, header followed by the
+		compressed data, into out at base, returns the header
+		"""
+
+		start, length, trimCount = item
+
+		targetAddr = self.startLBA + (start >> self.blockShift)
+		chunkName = self.baseName + str(targetAddr) + ".bin"
+
+		file = self.openImage()
+
+		values = {
+			'sliceName':	self.sliceName,
+			'chunkName':	chunkName.encode("utf8"),
+			'targetSize':	length,
+			'targetAddr':	targetAddr,
+			'trimCount':	trimCount,
+			'dev':		self.dev,
+		}
+
+		out.seek(base + self._dz_length, io.SEEK_SET)
+
+		# same place, same size in the reference DZ, same contents?
+		candidates = self.reference.find(self.dev, targetAddr, length) if self.reference else []
+		if candidates:
+			md5 = hashlib.md5()
+			crc = zcrc32(b"")
+			for buf in BlockReader(file, start, length, self.readSize, self.fileName):
+				md5.update(buf)
+				crc = zcrc32(buf, crc)
+
+			for ref in candidates:
+				if ref['md5'] == md5.digest() and ref['crc32'] == crc & 0xFFFFFFFF:
+					break
+			else:
+				ref = None
 
-		buf = self.file.read(readSize)
+			if ref:
+				print("[+] Reusing {:s} from {:s} ({:d} empty blocks)".format(chunkName, self.reference.name, trimCount - (length >> self.blockShift)))
 
-		while len(buf.lstrip(b'\x00')) == 0 and current < eof:
+				source = io.FileIO(self.reference.name, "rb")
+				if copyrange.copyRange(source, out, ref['dataOffset'], base + self._dz_length, ref['dataSize']) != ref['dataSize']:
+					print("[!] Error: {:s} is shorter than expected".format(self.reference.name), file=sys.stderr)
+					sys.exit(1)
+				source.close()
+				file.close()
+
+				values['dataSize'] = ref['dataSize']
+				values['md5'] = ref['md5']
+				values['crc32'] = ref['crc32']
+
+				header = self.packdict(values)
+				out.seek(base, io.SEEK_SET)
+				out.write(header)
+				return header
+
+		level, estimate = self.chunkLevel(file, start, length)
+
+		pieces = iter(BlockReader(file, start, length, self.readSize, self.fileName))
+		buf = next(pieces, None)
+
+		print("[+] Compressing {:s} to {:s} ({:d} empty blocks, ~{:d}%{:s})".format(self.fileName, chunkName, trimCount - (length >> self.blockShift), int(estimate * 100 + 0.5), ", stored" if level == 0 else ""))
+
+		md5 = hashlib.md5()
+		crc = zcrc32(b"")
+		# in split mode the workers share the deflate of large chunks
+		if self.split and length >= self.splitSize << 1:
+			zobj = pzlib.ParallelCompress(level, self.jobs, self.splitSize)
+		else:
+			zobj = zlib.compressobj(level)
+		zlen = 0
+
+		while buf != None:
 			md5.update(buf)
-			crc = crc32(buf, crc)
+			crc = zcrc32(buf, crc)
 			zdata = zobj.compress(buf)
 			zlen += len(zdata)
 			out.write(zdata)
-			wipeData += readSize
-			dataCount += readSize
-			current += readSize
 
-			buf = self.file.read(readSize)
+			buf = next(pieces, None)
 
+		zdata = zobj.flush(zlib.Z_FINISH)
+		zlen += len(zdata)
+		out.write(zdata)
 
+		file.close()
 
-		while current < eof:
+		values['dataSize'] = zlen
+		values['md5'] = md5.digest()
+		values['crc32'] = crc & 0xFFFFFFFF
 
+		header = self.packdict(values)
+		out.seek(base, io.SEEK_SET)
+		out.write(header)
 
+		return header
 
 
-			while len(buf.lstrip(b'\x00')) != 0 and current < eof:
-				md5.update(buf)
-				crc = crc32(buf, crc)
-				zdata = zobj.compress(buf)
-				zlen += len(zdata)
-				out.write(zdata)
-				wipeData += readSize
-				dataCount += readSize
-				current += readSize
+	def estimateChunk(self, item):
+		"""
+		Predict the compressed size of one planned chunk and how long
+		compressing it will take, from samples of it.  The chunk is cut
+		into strata, one sample is taken at random from each (always the
+		start of the first).  Whether it is stored is decided as the real
+		run does.
+		"""
 
-				buf = self.file.read(readSize)
+		start, length, trimCount = item
 
-			zdata = zobj.flush(zlib.Z_FINISH)
-			zlen += len(zdata)
-			out.write(zdata)
-			md5 = md5.digest()
+		targetAddr = self.startLBA + (start >> self.blockShift)
+		chunkName = self.baseName + str(targetAddr) + ".bin"
+
+		# all hole, nothing to sample or compress
+		if length == 0:
+			return (chunkName, 0, len(zlib.compress(b"", self.level)), 0.0)
+
+		# the reads are timed too, as the real run has to do them all
+		begin = time.time()
+		file = self.openImage()
 
+		# seeded by the chunk, so estimates are repeatable
+		rng = random.Random(start)
+		stratum = self.sampleSize * self.estimateFraction
 
+		samples = []
+		for base in range(start, start + length, stratum):
+			span = min(stratum, start + length - base)
+			offset = base
+			if base != start and span > self.sampleSize:
+				offset += rng.randrange(0, span - self.sampleSize) & ~(self.blockSize - 1)
+			file.seek(offset, io.SEEK_SET)
+			samples.append(file.read(min(self.sampleSize, start + length - offset)))
 
-			while len(buf.lstrip(b'\x00')) == 0 and current < eof:
-				wipeData += readSize
-				current += readSize
-				buf = self.file.read(readSize)
+		level = self.chunkLevel(file, start, length)[0]
 
+		file.close()
+		elapsed = time.time() - begin
 
-			print("({:d} empty blocks)".format((wipeData - dataCount) >> self.blockShift))
+		size = 0
+		zsize = 0
+		begin = time.time()
+		for sample in samples:
+			hashlib.md5(sample)
+			zcrc32(sample)
+			size += len(sample)
+			zsize += len(zlib.compress(sample, level))
+		elapsed += time.time() - begin
 
+		dataSize = zsize * length // size
+		seconds = elapsed * length / size
 
+		print("[+] {:s} to {:s}: {:d} bytes, ~{:d} compressed{:s}".format(self.fileName, chunkName, length, dataSize, ", stored" if level == 0 else ""))
 
+		return (chunkName, length, dataSize, seconds)
 
 
+	def chunkOverhead(self):
+		"""
+		Measure the fixed cost of each chunk, setting up the hashes and
+		deflate and packing its header, which dominates for small chunks.
+		It is done in memory, a dry run leaves nothing behind.
+		"""
+
+		values = {
+			'sliceName':	self.sliceName,
+			'chunkName':	self.fileName.encode("utf8"),
+			'targetSize':	0,
+			'targetAddr':	0,
+			'trimCount':	0,
+			'dev':		self.dev,
+			'dataSize':	0,
+			'crc32':	0,
+		}
+		count = 16
+
+		begin = time.time()
+		for idx in range(count):
+			out = io.BytesIO()
+			out.seek(self._dz_length, io.SEEK_SET)
+			out.write(zlib.compressobj(self.level).flush())
+			values['md5'] = hashlib.md5().digest()
+			values['crc32'] = zcrc32(b"") & 0xFFFFFFFF
 			out.seek(0, io.SEEK_SET)
+			out.write(self.packdict(values))
+		elapsed = time.time() - begin
 
-			values = {
-				'sliceName':	sliceName,
-				'chunkName':	chunkName,
-				'targetSize':	dataCount,
-				'dataSize':	zlen,
-				'md5':		md5,
-				'targetAddr':	targetAddr,
-				'trimCount':	wipeData >> self.blockShift,
-				'crc32':	crc & 0xFFFFFFFF,
-				'dev':		self.dev,
-			}
+		return elapsed / count
 
-			header = self.packdict(values)
-			out.write(header)
-			out.close()
 
+	def estimateChunks(self, plan):
+		"""
+		Dry run, predict the .chunk files instead of making them
+		"""
 
+		overhead = self.chunkOverhead()
 
+		self.estimates = []
+		for item in plan:
+			name, length, dataSize, seconds = self.estimateChunk(item)
+			self.estimates.append((name, length, dataSize, seconds + overhead))
 
-			targetAddr = self.startLBA + (current >> self.blockShift)
+		total = sum(dataSize for name, length, dataSize, seconds in self.estimates)
+		seconds = sum(seconds for name, length, dataSize, seconds in self.estimates)
+
+		print("[+] {:s}: {:d} chunks, ~{:d} bytes compressed, ~{:.1f}s of compression".format(self.fileName, len(plan), total, seconds))
+
+
+	def settings(self, strategy):
+		"""
+		Return a dict of everything besides the contents of the image
+		and reference DZ which affects the .chunk files.  The level is
+		the policy given rather than the one chosen, which isn't known
+		until the image has been planned, so with "time:SECONDS" runs on
+		different machines may share chunks made at different levels.
+		"""
+
+		values = dict(self.params)
+		values['fileName'] = self.fileName
+		values['strategy'] = strategy.__name__
+		values['level'] = self.policy
+		values['split'] = self.splitSize if self.split else 0
+		values['probeHole'] = self.probeHole
+		values['incompressible'] = self.incompressible
+		values['reference'] = self.reference.name if self.reference else ""
+
+		return values
+
+
+	def cacheKey(self, strategy):
+		"""
+		Return the build cache key for our image, covering everything
+		which affects the .chunk files
+		"""
+
+		values = self.settings(strategy)
+		values['image'] = self.cache.fingerprint(self.imageName)
+		values['referenceContents'] = self.cache.fingerprint(self.reference.name) if self.reference else ""
+
+		return self.cache.key(values)
+
+
+	def journalKey(self, strategy):
+		"""
+		Return the key of our run for the journal, the sizes and
+		modification times of the image and reference DZ stand in for
+		their contents
+		"""
+
+		values = self.settings(strategy)
+		st = os.stat(self.imageName)
+		values['image'] = "{:d} {:d}".format(st.st_size, int(st.st_mtime * 1000000))
+		if self.reference:
+			st = os.stat(self.reference.name)
+			values['referenceContents'] = "{:d} {:d}".format(st.st_size, int(st.st_mtime * 1000000))
+		values['chosen'] = self.level
+
+		desc = ";".join("{:s}={:s}".format(k, str(values[k])) for k in sorted(values.keys()))
 
+		return hashlib.sha1(desc.encode("utf8")).hexdigest()
 
-			if current < eof:
 
+	def openJournal(self, key):
+		"""
+		Load the journal left by an interrupted run with the same key,
+		then start ours.  Each finished chunk gets a line with its range,
+		output size and header, chunks of the earlier run which are still
+		intact are carried over.
+		"""
+
+		self.journalName = os.path.join(self.dirName, self.fileName + ".journal")
+		self.journalLock = threading.Lock()
+		self.finished = {}
+
+		try:
+			with io.open(self.journalName, "rt") as file:
+				lines = file.read().split("\n")
+		except IOError:
+			lines = [""]
+
+		if lines[0] == key:
+			for line in lines[1:]:
+				fields = line.split(" ")
+				# the last line may be incomplete
+				if len(fields) != 5 or len(fields[4]) != self._dz_length << 1:
+					continue
+				start, length, trimCount, size = [int(x) for x in fields[:4]]
+				self.finished[(start, length, trimCount)] = (size, unhexlify(fields[4]))
+
+		self.journal = io.open(self.journalName + ".new", "wt")
+		self.journal.write(u"{:s}\n".format(key))
+		self.journal.flush()
+		os.rename(self.journalName + ".new", self.journalName)
+
+
+	def resumeChunk(self, item):
+		"""
+		Return the name of item's .chunk file if the interrupted run
+		finished it and it is still intact, otherwise None
+		"""
+
+		if item not in self.finished:
+			return None
 
-				md5 = hashlib.md5()
-				crc = crc32(b"")
-				zobj = zlib.compressobj(1)
+		size, header = self.finished[item]
+		targetAddr = self.startLBA + (item[0] >> self.blockShift)
+		name = self.baseName + str(targetAddr) + ".bin.chunk"
 
-				chunkName = baseName + str(targetAddr) + ".bin"
-				out = io.FileIO(chunkName + ".chunk", "wb")
+		try:
+			with io.FileIO(os.path.join(self.dirName, name), "rb") as file:
+				if os.fstat(file.fileno()).st_size != size or file.read(self._dz_length) != header:
+					return None
+		except IOError:
+			return None
 
-				sys.stdout.write("[+] Compressing {:s} to {:s} ".format(name, chunkName))
+		print("[+] {:s} was finished by an earlier run, reusing it".format(name))
 
-				chunkName = chunkName.encode("utf8")
-				out.seek(self._dz_length, io.SEEK_SET)
-				zlen = 0
+		self.journalChunk(item, name)
 
-				wipeData = readSize
-				dataCount = readSize
+		return name
 
 
+	def journalChunk(self, item, name):
+		"""
+		Record in the journal that item's .chunk file name is complete
+		"""
 
+		with io.FileIO(os.path.join(self.dirName, name), "rb") as file:
+			header = file.read(self._dz_length)
+			size = os.fstat(file.fileno()).st_size
+
+		with self.journalLock:
+			self.journal.write(u"{:d} {:d} {:d} {:d} {:s}\n".format(item[0], item[1], item[2], size, hexlify(header).decode("ascii")))
+			self.journal.flush()
+
+
+	def closeJournal(self):
+		"""
+		All chunks are done, the journal is no longer needed
+		"""
 
+		self.journal.close()
+		os.remove(self.journalName)
 
 
+	def makeChunks(self, name, strategy):
+		"""
+		Generate one or more .chunks files for the named file, first the
+		chunks are planned, then compressed (several at once if allowed).
+		If only planning, the plan is kept for writeChunk() instead.
+		"""
+
+		self.imageName = name
+		self.dirName = os.path.dirname(name) or "."
+		self.fileName = os.path.basename(name)
+		self.baseName = self.fileName.rpartition(".")[0] + "_"
+		self.sliceName = self.fileName.rpartition(".")[0].encode("utf8")
+
+		# unchanged since last time?
+		if self.cache and not self.dryRun and not self.planOnly:
+			key = self.cacheKey(strategy)
+			names = self.cache.restore(key, self.dirName)
+			if names != None:
+				print("[+] {:s} unchanged, restored {:d} chunks from cache".format(self.fileName, len(names)))
+				self.file.close()
+				print("[+] done\n")
+				return
+
+		with self.budget.reserve():
+			begin = time.time()
+			plan = self.limitPlan(strategy())
+			self.planTime = time.time() - begin
+			print("[+] Planned {:d} chunks for {:s} in {:.2f}s".format(len(plan), self.fileName, self.planTime))
+			self.level = self.chooseLevel(plan)
+
+		if self.dryRun:
+			self.estimateChunks(plan)
+			self.file.close()
+			print("[+] done\n")
+			return
+
+		# our caller writes the chunks
+		if self.planOnly:
+			self.plan = plan
+			self.file.close()
+			return
+
+		# pick up where an interrupted run left off
+		self.openJournal(self.journalKey(strategy))
+
+		# split mode works within chunks, so they're done one at a time
+		names = jobs.runJobs(self.makeChunk, plan, 1 if self.split else self.jobs)
+
+		self.file.close()
+		self.closeJournal()
+
+		if self.cache:
+			self.cache.store(key, self.dirName, names)
+
 		print("[+] done\n")
 
 
-	def __init__(self, name, strategy):
+	def __init__(self, name, strategy, workers=1, split=False, reference=None, cache=None, policy="1", budget=None, dryRun=False, planOnly=False):
 		"""
-		Initializer for Image2Chunks class, takes filename as arg
+		Initializer for Image2Chunks class, takes filename as arg, budget
+		is shared with any other images being done at the same time
 		"""
 
 		super(Image2Chunks, self).__init__()
 
+		self.jobs = workers
+		self.budget = budget if budget else jobs.Budget(workers)
+		self.dryRun = dryRun
+		self.planOnly = planOnly
+		self.policy = policy
+		self.split = split
+		self.reference = reference
+		self.cache = cache
+
 		self.openFiles(name)
 
 		if self.loadParams(name):
-			if strategy == 0:
-				self.makeChunksEXT4FS(name)
+			if self.isSparse():
+				print("[+] {:s} is an Android sparse image, using its chunks".format(name))
+				self.makeChunks(name, self.planSparse)
+			elif strategy == 0:
+				self.makeChunks(name, self.planEXT4FS)
 			elif strategy == 1:
-				self.makeChunksHoles(name)
+				self.makeChunks(name, self.planHoles)
 			elif strategy == 2:
-				self.makeChunksProbe(name)
+				self.makeChunks(name, self.planProbe)
+			elif strategy == 3:
+				self.makeChunks(name, self.chooseStrategy(name))
+			elif strategy == 4:
+				self.makeChunks(name, self.planF2FS)
 			elif strategy == None:
 				print("[!] No strategy specified, one *must* be specified before filename(s)", file=sys.stderr)
 				sys.exit(1)
@@ -734,13 +1752,31 @@ class Image2Chunks(dz.DZChunk):
 
 
 def help(progname):
-	print("usage: {:s} [-h | --help] [-e | --ext4 | -s | --sparse | -p | --probe] <file(s)>\n".format(progname))
+	print("usage: {:s} [-h | --help] [-j N | --jobs N] [-b | --split-deflate] [-r F | --reference F] [-c DIR | --cache DIR] [--cache-size MB] [-l P | --level P] [--memory MB] [-n | --dry-run] [-a | --auto | -e | --ext4 | -f | --f2fs | -s | --sparse | -p | --probe] <file(s)>\n".format(progname))
 	print("DZ Chunking program by Elliott Mitchell\n")
 	print("optional arguments:")
 	print("  -h | --help           show this help message and exit")
-	print("  -e | --ext4           use Android's sparse EXT4 dump utility (recommended)")
+	print("  -a | --auto           pick a strategy for each image from its contents")
+	print("  -e | --ext4           use the EXT2/3/4 block bitmaps (recommended)")
+	print("  -f | --f2fs           use the F2FS segment information table")
 	print("  -s | --sparse         use SEEK_DATA/SEEK_HOLE (not available on all OSes)")
 	print("  -p | --probe          probe for holes (safe)")
+	print("  -j N | --jobs N       compress up to N chunks at once, across all the images")
+	print("  -b | --split-deflate  instead split each large chunk into blocks, compressed")
+	print("                        N at once (output differs from normal, still valid)")
+	print("  -r F | --reference F  copy unchanged chunks from the DZ (or KDZ) file F,")
+	print("                        instead of compressing them again")
+	print("  -c DIR | --cache DIR  keep the chunks in cache DIR, unchanged images are")
+	print("                        restored from there instead of being redone")
+	print("  --cache-size MB       limit the cache to MB megabytes (default 4096)")
+	print("  -l P | --level P      compression policy, a level 0-9 (default 1), \"fastest\",")
+	print("                        \"smallest\" or \"time:SECONDS\" (smallest expected to")
+	print("                        take no longer per image, levels are tried on samples)")
+	print("  --memory MB           limit the memory used by chunks being compressed at")
+	print("                        once to about MB megabytes (default unlimited)")
+	print("  -n | --dry-run        only estimate the size of the chunks and DZ file and")
+	print("                        how long it would take, from samples")
+	print("\nAndroid sparse images are recognized, their chunks are used without a strategy")
 	sys.exit(0)
 
 
@@ -749,19 +1785,95 @@ if __name__ == "__main__":
 	progname = sys.argv[0]
 	del sys.argv[0]
 
-	basedir = os.open(".", os.O_DIRECTORY)
-
-	# no default strategy, ext2simg is reasonable, but worrisome if non-FS
+	# no default strategy, EXT4 is reasonable, but worrisome if non-FS
 	strategy = None
 
+	# number of chunks to compress at once
+	workers = 1
+
+	# split the deflate of large chunks across the workers
+	split = False
+
+	# DZ file to copy unchanged chunks from
+	reference = None
+
+	# compression policy
+	policy = "1"
+
+	# build cache, created once all options are seen
+	cacheDir = None
+	cacheSize = 4096
+	cache = None
+
+	# memory limit for everything being done at once
+	memory = None
+
+	# images along with the strategy in effect for each
+	images = []
+
+	# only estimate
+	dryRun = False
+
 	if len(sys.argv) <= 0:
 		help(progname)
 
-	for arg in sys.argv:
+	args = iter(sys.argv)
+	for arg in args:
 
 		if arg[0] == "-":
-			if arg == "-e" or arg == "--ext4":
+			if arg == "-j" or arg == "--jobs" or arg[:7] == "--jobs=":
+				try:
+					workers = int(arg[7:] if arg[:7] == "--jobs=" else next(args))
+				except (ValueError, StopIteration):
+					print('[!] Option "{:s}" needs a number'.format(arg))
+					sys.exit(1)
+			elif arg == "-r" or arg == "--reference" or arg[:12] == "--reference=":
+				try:
+					reference = ReferenceDZ(arg[12:] if arg[:12] == "--reference=" else next(args))
+				except StopIteration:
+					print('[!] Option "{:s}" needs a file name'.format(arg))
+					sys.exit(1)
+			elif arg == "-c" or arg == "--cache" or arg[:8] == "--cache=":
+				try:
+					cacheDir = arg[8:] if arg[:8] == "--cache=" else next(args)
+				except StopIteration:
+					print('[!] Option "{:s}" needs a directory'.format(arg))
+					sys.exit(1)
+			elif arg == "--cache-size" or arg[:13] == "--cache-size=":
+				try:
+					cacheSize = int(arg[13:] if arg[:13] == "--cache-size=" else next(args))
+				except (ValueError, StopIteration):
+					print('[!] Option "{:s}" needs a number'.format(arg))
+					sys.exit(1)
+			elif arg == "--memory" or arg[:9] == "--memory=":
+				try:
+					memory = int(arg[9:] if arg[:9] == "--memory=" else next(args)) << 20
+				except (ValueError, StopIteration):
+					print('[!] Option "{:s}" needs a number'.format(arg))
+					sys.exit(1)
+			elif arg == "-l" or arg == "--level" or arg[:8] == "--level=":
+				try:
+					policy = arg[8:] if arg[:8] == "--level=" else next(args)
+					if policy.isdigit():
+						if int(policy) > 9:
+							raise ValueError
+					elif policy[:5] == "time:":
+						float(policy[5:])
+					elif policy != "fastest" and policy != "smallest":
+						raise ValueError
+				except (ValueError, StopIteration):
+					print('[!] Option "{:s}" needs a level 0-9, "fastest", "smallest" or "time:SECONDS"'.format(arg))
+					sys.exit(1)
+			elif arg == "-n" or arg == "--dry-run":
+				dryRun = True
+			elif arg == "-b" or arg == "--split-deflate":
+				split = True
+			elif arg == "-a" or arg == "--auto":
+				strategy = 3
+			elif arg == "-e" or arg == "--ext4":
 				strategy = 0
+			elif arg == "-f" or arg == "--f2fs":
+				strategy = 4
 			elif arg == "-s" or arg == "--sparse":
 				strategy = 1
 			elif arg == "-p" or arg == "--probe":
@@ -775,7 +1887,26 @@ if __name__ == "__main__":
 
 			continue
 
-		Image2Chunks(arg, strategy)
+		images.append((arg, strategy))
+
+	if cacheDir:
+		cache = buildcache.BuildCache(cacheDir, cacheSize << 20)
+
+	# images are done several at once, all sharing one budget
+	budget = jobs.Budget(workers, memory)
+	done = jobs.runJobs(lambda image: Image2Chunks(image[0], image[1], workers, split, reference, cache, policy, budget, dryRun), images, workers)
+
+	if dryRun:
+		# the DZ file is its header followed by the .chunk files
+		size = dz.DZFile._dz_length
+		durations = []
+		for image in done:
+			for name, length, dataSize, seconds in image.estimates:
+				size += image._dz_length + dataSize
+				# split mode shares large chunks among the workers
+				durations.append(seconds / workers if split and length >= image.splitSize << 1 else seconds)
+
+		elapsed = jobs.simulateJobs([image.planTime for image in done], workers) + jobs.simulateJobs(durations, workers)
 
-		os.fchdir(basedir)
+		print("[+] Estimated DZ file size ~{:d} bytes ({:d}MB), ~{:.1f}s with {:d} worker(s)".format(size, (size + (1 << 19)) >> 20, elapsed, workers))
 
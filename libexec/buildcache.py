@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 Elliott Mitchell <ehem+android@m5p.com>
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import io
+import errno
+import shutil
+import hashlib
+import threading
+
+import copyrange
+
+
+class BuildCache(object):
+	"""
+	Persistent cache of generated files, keyed by a fingerprint of the
+	inputs and settings which produced them.  Each entry is a directory
+	holding the files, its modification time records the last use, the
+	least recently used entries are evicted once over the size limit.
+	"""
+
+	# Bump if what is stored changes
+	version = 1
+
+	# Size of reads while fingerprinting
+	readSize = 1<<20
+
+	def _path(self, *parts):
+		"""
+		Return the path of parts within the cache
+		"""
+		return os.path.join(self.dir, *parts)
+
+	def _unique(self):
+		"""
+		Return a suffix for temporary names no other process or thread
+		is using
+		"""
+		return "{:d}.{:d}".format(os.getpid(), threading.current_thread().ident)
+
+	def fingerprint(self, name):
+		"""
+		Return a SHA-1 of the contents of name.  Remembered along with
+		the size, modification time and inode, so unchanged files aren't
+		read again.
+		"""
+
+		st = os.stat(name)
+		stamp = "{:d} {:d} {:d}".format(st.st_size, int(st.st_mtime * 1000000), st.st_ino)
+		memo = self._path("stat", hashlib.sha1(os.path.abspath(name).encode("utf8")).hexdigest())
+
+		try:
+			with io.open(memo, "rt") as file:
+				line = file.read().split("\n")[0].rpartition(" ")
+			if line[0] == stamp:
+				return line[2]
+		except IOError:
+			pass
+
+		digest = hashlib.sha1()
+		with io.FileIO(name, "rb") as file:
+			buf = file.read(self.readSize)
+			while len(buf) > 0:
+				digest.update(buf)
+				buf = file.read(self.readSize)
+		digest = digest.hexdigest()
+
+		tmp = memo + "." + self._unique()
+		with io.open(tmp, "wt") as file:
+			file.write(u"{:s} {:s}\n".format(stamp, digest))
+		os.rename(tmp, memo)
+
+		return digest
+
+	def key(self, values):
+		"""
+		Return the cache key for the dict values (strings and integers)
+		"""
+
+		desc = ";".join("{:s}={:s}".format(k, str(values[k])) for k in sorted(values.keys()))
+		desc = "version={:d};{:s}".format(self.version, desc)
+
+		return hashlib.sha1(desc.encode("utf8")).hexdigest()
+
+	def restore(self, key, dest):
+		"""
+		Copy the files of entry key into directory dest, returns their
+		names, None if there is no such entry
+		"""
+
+		entry = self._path("entries", key)
+
+		try:
+			names = sorted(os.listdir(entry))
+		except OSError:
+			return None
+
+		# mark it recently used
+		try:
+			os.utime(entry, None)
+		except OSError:
+			pass
+
+		for name in names:
+			src = io.FileIO(os.path.join(entry, name), "rb")
+			dst = io.FileIO(os.path.join(dest, name), "wb")
+			size = os.fstat(src.fileno()).st_size
+			if copyrange.copyRange(src, dst, 0, 0, size) != size:
+				print("[!] Error: cache entry {:s} changed while in use".format(key), file=sys.stderr)
+				sys.exit(1)
+			src.close()
+			dst.close()
+
+		return names
+
+	def store(self, key, src, names):
+		"""
+		Save copies of names from directory src as entry key
+		"""
+
+		entry = self._path("entries", key)
+		tmp = self._path("tmp", key + "." + self._unique())
+
+		os.mkdir(tmp)
+		for name in names:
+			shutil.copyfile(os.path.join(src, name), os.path.join(tmp, name))
+
+		try:
+			os.rename(tmp, entry)
+		except OSError:
+			# someone else got there first
+			shutil.rmtree(tmp, True)
+
+		self.evict()
+
+	def evict(self):
+		"""
+		Remove the least recently used entries until the cache fits in
+		its size limit
+		"""
+
+		entries = []
+		total = 0
+
+		for key in os.listdir(self._path("entries")):
+			entry = self._path("entries", key)
+			# another thread may be evicting too
+			try:
+				size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+				entries.append((os.path.getmtime(entry), size, entry))
+			except OSError:
+				continue
+			total += size
+
+		entries.sort()
+		while total > self.limit and entries:
+			used, size, entry = entries.pop(0)
+			shutil.rmtree(entry, True)
+			total -= size
+
+	def __init__(self, dir, limit=4<<30):
+		"""
+		Initialize BuildCache, stored in dir, limited to about limit
+		bytes
+		"""
+
+		super(BuildCache, self).__init__()
+
+		self.dir = os.path.abspath(dir)
+		self.limit = limit
+
+		for sub in "entries", "stat", "tmp":
+			try:
+				os.makedirs(self._path(sub))
+			except OSError as err:
+				if err.errno != errno.EEXIST:
+					raise
+
+
+
+if __name__ == "__main__":
+	print("Sorry, this file is an internal library and doesn't do anything interesting by", file=sys.stderr)
+	print("itself.", file=sys.stderr)
+	sys.exit(1)
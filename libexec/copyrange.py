@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 Elliott Mitchell <ehem+android@m5p.com>
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import io
+import errno
+import threading
+
+
+# Size of the buffers used when the kernel can't do the copy for us
+bufferSize = 8<<20
+
+# Largest single request handed to the kernel (some reject >2GB)
+_kernelMax = 1<<30
+
+# errno values indicating a copy method doesn't work for these files
+_unsupported = set([errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF,
+	getattr(errno, "EOPNOTSUPP", errno.EINVAL), getattr(errno, "ENOTSUP", errno.EINVAL)])
+
+# the buffers are recycled, one per thread
+_buffers = threading.local()
+
+
+def _getBuffer():
+	"""
+	Return this thread's reusable copy buffer
+	"""
+	try:
+		return _buffers.view
+	except AttributeError:
+		_buffers.view = memoryview(bytearray(bufferSize))
+		return _buffers.view
+
+
+def _fileno(file):
+	"""
+	Flush any pending buffered data and return the descriptor
+	"""
+	if hasattr(file, "flush"):
+		file.flush()
+	return file.fileno() if hasattr(file, "fileno") else file
+
+
+def _copyKernel(srcfd, dstfd, srcOffset, dstOffset, length):
+	"""
+	Copy using os.copy_file_range(), then os.sendfile(), return the
+	number of bytes copied (may be short if neither is usable)
+	"""
+
+	done = 0
+
+	if hasattr(os, "copy_file_range"):
+		try:
+			while done < length:
+				count = os.copy_file_range(srcfd, dstfd, min(length - done, _kernelMax), srcOffset + done, dstOffset + done)
+				if count <= 0:
+					break
+				done += count
+		except OSError as err:
+			if err.errno not in _unsupported:
+				raise
+
+	if done < length and hasattr(os, "sendfile"):
+		try:
+			# sendfile() writes at the current position of the output
+			os.lseek(dstfd, dstOffset + done, os.SEEK_SET)
+			while done < length:
+				count = os.sendfile(dstfd, srcfd, srcOffset + done, min(length - done, _kernelMax))
+				if count <= 0:
+					break
+				done += count
+		except OSError as err:
+			if err.errno not in _unsupported:
+				raise
+
+	return done
+
+
+def _copyBuffered(srcfd, dstfd, srcOffset, dstOffset, length, consumer):
+	"""
+	Copy through a large recycled buffer, return bytes copied
+	"""
+
+	view = _getBuffer()
+	done = 0
+
+	# Python 2 lacks positional I/O, fall back to seeking
+	if not hasattr(os, "pwrite"):
+		src = io.FileIO(srcfd, "rb", closefd=False)
+		dst = io.FileIO(dstfd, "wb", closefd=False)
+		src.seek(srcOffset, io.SEEK_SET)
+		dst.seek(dstOffset, io.SEEK_SET)
+
+	while done < length:
+		want = min(length - done, len(view))
+
+		# the consumer may hang onto the data, so it gets a fresh buffer
+		if consumer:
+			if hasattr(os, "pread"):
+				data = os.pread(srcfd, want, srcOffset + done)
+			else:
+				data = src.read(want)
+			count = len(data)
+		elif hasattr(os, "preadv"):
+			count = os.preadv(srcfd, [view[:want]], srcOffset + done)
+			data = view
+		elif hasattr(os, "pread"):
+			data = os.pread(srcfd, want, srcOffset + done)
+			count = len(data)
+			data = memoryview(data)
+		else:
+			count = src.readinto(view[:want])
+			data = view
+
+		if not count:
+			break
+
+		if consumer:
+			consumer(data, dstOffset + done)
+			data = memoryview(data)
+
+		written = 0
+		while written < count:
+			if hasattr(os, "pwrite"):
+				written += os.pwrite(dstfd, data[written:count], dstOffset + done + written)
+			else:
+				written += dst.write(data[written:count])
+
+		done += count
+
+	return done
+
+
+def copyRange(src, dst, srcOffset, dstOffset, length, consumer=None):
+	"""
+	Copy length bytes from src starting at srcOffset into dst starting
+	at dstOffset.  src and dst are file objects or descriptors.
+
+	The kernel does the copy if it is able (os.copy_file_range() then
+	os.sendfile()), otherwise large buffered copies are used.  The
+	position of src is neither used nor modified, so several threads
+	may copy out of a single source concurrently.  When sendfile() or
+	Python 2 is in use the position of dst is modified, so each thread
+	needs its own dst.
+
+	If consumer is given the data has to pass through user space, each
+	piece is handed to consumer(data, dstOffset) as it is copied.
+
+	Returns the number of bytes copied, short only if src hits EOF.
+	"""
+
+	srcfd = _fileno(src)
+	dstfd = _fileno(dst)
+
+	done = 0 if consumer else _copyKernel(srcfd, dstfd, srcOffset, dstOffset, length)
+
+	if done < length:
+		done += _copyBuffered(srcfd, dstfd, srcOffset + done, dstOffset + done, length - done, consumer)
+
+	return done
+
+
+
+if __name__ == "__main__":
+	print("Sorry, this file is an internal library and doesn't do anything interesting by", file=sys.stderr)
+	print("itself.", file=sys.stderr)
+	sys.exit(1)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 Elliott Mitchell <ehem+android@m5p.com>
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import sys
+import io
+import re
+from collections import OrderedDict
+from struct import Struct
+
+
+verbose = lambda msg: None
+
+
+class NoEXT4(Exception):
+	def __init__(self, errmsg):
+		self.errmsg = errmsg
+	def __str__(self):
+		return self.errmsg
+
+
+# spans of free or fully used bitmap bytes
+_notFree = re.compile(b"[^\x00]")
+_notUsed = re.compile(b"[^\xFF]")
+
+
+def bitmapRuns(bitmap, count):
+	"""
+	Return a list of (start, end) runs of set bits among the first count
+	bits of bitmap (ext2/3/4 bitmaps are little-endian).  Whole bytes of
+	zeros or ones are skipped using the regular expression engine.
+	"""
+
+	runs = []
+	start = None
+	size = min(len(bitmap), (count + 7) >> 3)
+	bitmap = bytearray(bitmap)
+
+	pos = 0
+	while pos < size:
+		byte = bitmap[pos]
+
+		if byte == 0x00 or byte == 0xFF:
+			match = (_notUsed if byte else _notFree).search(bitmap, pos, size)
+			if byte and start == None:
+				start = pos << 3
+			elif not byte and start != None:
+				runs.append((start, pos << 3))
+				start = None
+			pos = match.start() if match else size
+			continue
+
+		for bit in range(8):
+			if byte & (1 << bit):
+				if start == None:
+					start = (pos << 3) + bit
+			elif start != None:
+				runs.append((start, (pos << 3) + bit))
+				start = None
+		pos += 1
+
+	if start != None:
+		runs.append((start, size << 3))
+
+	# padding at the end of the last group is marked in use
+	return [(s, min(e, count)) for s, e in runs if s < count]
+
+
+class EXT4FS(object):
+	"""
+	Minimal reader for EXT2/3/4 filesystems, only enough to find which
+	blocks are in use from the superblock, group descriptors and block
+	bitmaps
+	"""
+
+	_sb_offset = 1024
+	_sb_length = 1024
+	_sb_magic = 0xEF53
+
+	# Superblock fields we need
+	#   itemName is the new dict key for the data to be stored under
+	#   offset is where the field is found in the superblock
+	#   formatString is the Python formatstring for struct.unpack()
+	# Example:
+	#   ('itemName', (offset, 'formatString'))
+	_sb_fmt = OrderedDict([
+		('blocksCountLo',	(0x004,	'I')),
+		('firstDataBlock',	(0x014,	'I')),
+		('logBlockSize',	(0x018,	'I')),
+		('logClusterSize',	(0x01C,	'I')),
+		('blocksPerGroup',	(0x020,	'I')),
+		('clustersPerGroup',	(0x024,	'I')),
+		('inodesPerGroup',	(0x028,	'I')),
+		('magic',		(0x038,	'H')),
+		('revLevel',		(0x04C,	'I')),
+		('inodeSize',		(0x058,	'H')),
+		('featureCompat',	(0x05C,	'I')),
+		('featureIncompat',	(0x060,	'I')),
+		('featureRoCompat',	(0x064,	'I')),
+		('reservedGdtBlocks',	(0x0CE,	'H')),
+		('descSize',		(0x0FE,	'H')),
+		('firstMetaBg',		(0x104,	'I')),
+		('blocksCountHi',	(0x150,	'I')),
+		('backupBgs',		(0x24C,	'2I')),
+	])
+
+	# Group descriptor fields, same arrangement
+	_gd_fmt = OrderedDict([
+		('blockBitmap',		(0x00,	'I')),
+		('inodeBitmap',		(0x04,	'I')),
+		('inodeTable',		(0x08,	'I')),
+		('flags',		(0x12,	'H')),
+	])
+
+	# Upper halves, present in 64-bit group descriptors
+	_gd_fmt_hi = OrderedDict([
+		('blockBitmap',		(0x20,	'I')),
+		('inodeBitmap',		(0x24,	'I')),
+		('inodeTable',		(0x28,	'I')),
+	])
+
+	# Features which matter for finding the bitmaps
+	compatSparseSuper2	= 0x0200
+	incompatMetaBg		= 0x0010
+	incompat64Bit		= 0x0080
+	roCompatSparseSuper	= 0x0001
+	roCompatGdtCsum		= 0x0010
+	roCompatBigalloc	= 0x0200
+	roCompatMetadataCsum	= 0x0400
+
+	# Group descriptor flag, block bitmap was never written
+	bgBlockUninit		= 0x0002
+
+	@staticmethod
+	def _unpack(fmt, buf, base=0):
+		"""
+		Unpack the fields described by fmt out of buf
+		"""
+		out = {}
+		for name, (offset, code) in fmt.items():
+			values = Struct("<" + code).unpack_from(buf, base + offset)
+			out[name] = values if len(values) > 1 else values[0]
+		return out
+
+	def _read(self, offset, length):
+		"""
+		Read length bytes at offset of the filesystem
+		"""
+		self.file.seek(offset, io.SEEK_SET)
+		buf = self.file.read(length)
+		if len(buf) != length:
+			raise NoEXT4("Filesystem truncated")
+		return buf
+
+	def _hasSuper(self, group):
+		"""
+		Does group hold a superblock (backup)?
+		"""
+
+		if group == 0:
+			return True
+
+		if self.featureCompat & self.compatSparseSuper2:
+			return group in self.backupBgs
+
+		if group <= 1 or not self.featureRoCompat & self.roCompatSparseSuper:
+			return True
+
+		if not group & 1:
+			return False
+
+		for base in 3, 5, 7:
+			power = base
+			while power < group:
+				power *= base
+			if power == group:
+				return True
+
+		return False
+
+	def _groupStart(self, group):
+		"""
+		First block of group
+		"""
+		return self.firstDataBlock + group * self.blocksPerGroup
+
+	def _descBlock(self, group):
+		"""
+		Block holding the descriptor for group
+		"""
+
+		perBlock = self.blockSize // self.descSize
+		metaGroup = group // perBlock
+
+		if not self.featureIncompat & self.incompatMetaBg or metaGroup < self.firstMetaBg:
+			return self.firstDataBlock + 1 + metaGroup
+
+		first = metaGroup * perBlock
+		return self._groupStart(first) + (1 if self._hasSuper(first) else 0)
+
+	def _baseMeta(self, group):
+		"""
+		Number of blocks at the start of group taken by the superblock
+		and group descriptors (backups)
+		"""
+
+		perBlock = self.blockSize // self.descSize
+		count = 1 if self._hasSuper(group) else 0
+
+		if not self.featureIncompat & self.incompatMetaBg or group // perBlock < self.firstMetaBg:
+			if count:
+				count += (self.groupCount + perBlock - 1) // perBlock + self.reservedGdtBlocks
+		elif group % perBlock in (0, 1, perBlock - 1):
+			count += 1
+
+		return count
+
+	def _loadDescriptors(self):
+		"""
+		Read all of the group descriptors
+		"""
+
+		self.groups = []
+		perBlock = self.blockSize // self.descSize
+
+		for first in range(0, self.groupCount, perBlock):
+			buf = self._read(self._descBlock(first) << self.blockShift, self.blockSize)
+			for idx in range(min(perBlock, self.groupCount - first)):
+				gd = self._unpack(self._gd_fmt, buf, idx * self.descSize)
+				if self.descSize >= 64:
+					for name, value in self._unpack(self._gd_fmt_hi, buf, idx * self.descSize).items():
+						gd[name] |= value << 32
+				self.groups.append(gd)
+
+	def _metaRuns(self):
+		"""
+		Runs of blocks always in use, the bitmaps and inode tables of
+		every group (with flex_bg these may be outside their group)
+		"""
+
+		tableBlocks = (self.inodesPerGroup * self.inodeSize + self.blockSize - 1) >> self.blockShift
+
+		runs = []
+		for gd in self.groups:
+			runs.append((gd['blockBitmap'], gd['blockBitmap'] + 1))
+			runs.append((gd['inodeBitmap'], gd['inodeBitmap'] + 1))
+			runs.append((gd['inodeTable'], gd['inodeTable'] + tableBlocks))
+
+		return runs
+
+	def usedRuns(self):
+		"""
+		Return a sorted list of (offset, length) in bytes of the areas of
+		the filesystem which are in use, adjacent areas merged
+		"""
+
+		# with bigalloc the bitmaps are of clusters
+		clusterShift = self.clusterShift - self.blockShift
+		uninitOk = self.featureRoCompat & (self.roCompatGdtCsum | self.roCompatMetadataCsum)
+
+		# with flex_bg the bitmaps are next to each other, so the reads
+		# can be merged
+		bitmaps = sorted((gd['blockBitmap'], group) for group, gd in enumerate(self.groups) if not (uninitOk and gd['flags'] & self.bgBlockUninit))
+		data = {}
+		idx = 0
+		while idx < len(bitmaps):
+			count = 1
+			while idx + count < len(bitmaps) and bitmaps[idx + count][0] == bitmaps[idx][0] + count:
+				count += 1
+			buf = self._read(bitmaps[idx][0] << self.blockShift, count << self.blockShift)
+			for i in range(count):
+				data[bitmaps[idx + i][1]] = buf[i << self.blockShift:(i + 1) << self.blockShift]
+			idx += count
+
+		runs = self._metaRuns()
+
+		# the boot block ahead of a 1K block filesystem isn't in a group
+		if self.firstDataBlock:
+			runs.append((0, self.firstDataBlock))
+
+		for group in range(self.groupCount):
+			start = self._groupStart(group)
+			blocks = min(self.blocksPerGroup, self.blocksCount - start)
+
+			# bitmap never written, only the superblock and descriptors
+			# (plus the blocks from _metaRuns()) are in use
+			if group not in data:
+				base = self._baseMeta(group)
+				if base:
+					runs.append((start, start + base))
+				continue
+
+			clusters = (blocks + (1 << clusterShift) - 1) >> clusterShift
+			for s, e in bitmapRuns(data[group], clusters):
+				runs.append((start + (s << clusterShift), min(start + (e << clusterShift), start + blocks)))
+
+		runs.sort()
+
+		out = []
+		for s, e in runs:
+			if out and s <= out[-1][1]:
+				out[-1][1] = max(out[-1][1], e)
+			else:
+				out.append([s, e])
+
+		return [(s << self.blockShift, (e - s) << self.blockShift) for s, e in out]
+
+	def __init__(self, file):
+		"""
+		Initialize EXT4FS from file (seekable, positioned arbitrarily)
+		"""
+
+		super(EXT4FS, self).__init__()
+
+		self.file = file
+
+		try:
+			buf = self._read(self._sb_offset, self._sb_length)
+		except NoEXT4:
+			raise NoEXT4("Too small for an EXT2/3/4 filesystem")
+
+		sb = self._unpack(self._sb_fmt, buf)
+
+		if sb['magic'] != self._sb_magic:
+			raise NoEXT4("No EXT2/3/4 superblock found")
+
+		if sb['logBlockSize'] > 6 or sb['blocksPerGroup'] == 0:
+			raise NoEXT4("Superblock values are implausible")
+
+		self.blockShift = 10 + sb['logBlockSize']
+		self.blockSize = 1 << self.blockShift
+		self.firstDataBlock = sb['firstDataBlock']
+		self.blocksPerGroup = sb['blocksPerGroup']
+		self.inodesPerGroup = sb['inodesPerGroup']
+		self.inodeSize = sb['inodeSize'] if sb['revLevel'] else 128
+		self.featureCompat = sb['featureCompat']
+		self.featureIncompat = sb['featureIncompat']
+		self.featureRoCompat = sb['featureRoCompat']
+		self.reservedGdtBlocks = sb['reservedGdtBlocks']
+		self.firstMetaBg = sb['firstMetaBg']
+		self.backupBgs = sb['backupBgs']
+
+		if self.featureIncompat & self.incompat64Bit:
+			self.blocksCount = sb['blocksCountLo'] | (sb['blocksCountHi'] << 32)
+			self.descSize = sb['descSize']
+			if self.descSize < 32 or self.descSize & (self.descSize - 1):
+				raise NoEXT4("Bad group descriptor size")
+		else:
+			self.blocksCount = sb['blocksCountLo']
+			self.descSize = 32
+
+		if self.featureRoCompat & self.roCompatBigalloc:
+			self.clusterShift = 10 + sb['logClusterSize']
+			if self.clusterShift < self.blockShift or self.blocksPerGroup != sb['clustersPerGroup'] << (self.clusterShift - self.blockShift):
+				raise NoEXT4("Bad cluster size")
+		else:
+			self.clusterShift = self.blockShift
+
+		self.size = self.blocksCount << self.blockShift
+		self.groupCount = (self.blocksCount - self.firstDataBlock + self.blocksPerGroup - 1) // self.blocksPerGroup
+
+		verbose("{:d} blocks of {:d} bytes in {:d} groups".format(self.blocksCount, self.blockSize, self.groupCount))
+
+		self._loadDescriptors()
+
+
+
+if __name__ == "__main__":
+	print("Sorry, this file is an internal library and doesn't do anything interesting by", file=sys.stderr)
+	print("itself.", file=sys.stderr)
+	sys.exit(1)
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 Elliott Mitchell <ehem+android@m5p.com>
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import sys
+import io
+import zlib
+from collections import OrderedDict
+from struct import Struct
+
+from ext4 import bitmapRuns
+
+
+verbose = lambda msg: None
+
+
+class NoF2FS(Exception):
+	def __init__(self, errmsg):
+		self.errmsg = errmsg
+	def __str__(self):
+		return self.errmsg
+
+
+# F2FS bitmaps are big-endian within bytes, ext2/3/4 ones little-endian,
+# reversing the bits lets us share bitmapRuns()
+_reverseBits = bytes(bytearray(int("{:08b}".format(i)[::-1], 2) for i in range(256)))
+
+
+class F2FS(object):
+	"""
+	Minimal reader for F2FS filesystems, only enough to find which
+	blocks are in use from the superblock, checkpoint and segment
+	information table (SIT, including its journal in the checkpoint)
+	"""
+
+	_sb_offset = 1024
+	_sb_length = 2048
+	_sb_magic = 0xF2F52010
+
+	# Superblock fields we need
+	#   itemName is the new dict key for the data to be stored under
+	#   offset is where the field is found in the superblock
+	#   formatString is the Python formatstring for struct.unpack()
+	# Example:
+	#   ('itemName', (offset, 'formatString'))
+	_sb_fmt = OrderedDict([
+		('magic',		(0x000,	'I')),
+		('logBlockSize',	(0x010,	'I')),
+		('logBlocksPerSeg',	(0x014,	'I')),
+		('blockCount',		(0x024,	'Q')),
+		('segmentCountSit',	(0x038,	'I')),
+		('segmentCountMain',	(0x044,	'I')),
+		('cpBlkaddr',		(0x04C,	'I')),
+		('sitBlkaddr',		(0x050,	'I')),
+		('mainBlkaddr',		(0x05C,	'I')),
+		('cpPayload',		(0x680,	'I')),
+	])
+
+	# Checkpoint fields, same arrangement
+	_cp_fmt = OrderedDict([
+		('checkpointVer',	(0x000,	'Q')),
+		('validBlockCount',	(0x010,	'Q')),
+		('ckptFlags',		(0x084,	'I')),
+		('cpPackTotalBlockCount',(0x088, 'I')),
+		('cpPackStartSum',	(0x08C,	'I')),
+		('sitVerBitmapBytesize',(0x09C,	'I')),
+		('natVerBitmapBytesize',(0x0A0,	'I')),
+		('checksumOffset',	(0x0A4,	'I')),
+	])
+
+	# Where the version bitmaps start in the checkpoint
+	_cp_bitmap = 0x0C0
+
+	# Checkpoint flags which matter to us
+	cpUmount		= 0x0001
+	cpCompactSum		= 0x0004
+	cpError			= 0x0008
+	cpFsck			= 0x0010
+	cpLargeNatBitmap	= 0x0400
+	cpDisabled		= 0x1000
+
+	# SIT entry, valid block count (low 10 bits), bitmap of the 512
+	# blocks of the segment and modification time
+	_sit_entry = Struct("<H64sQ")
+
+	# SIT journal entry, segment number followed by a SIT entry
+	_sit_journal = Struct("<I")
+
+	# The current cold data segment's summary block holds the SIT journal
+	_coldData = 2
+
+	@staticmethod
+	def _unpack(fmt, buf, base=0):
+		"""
+		Unpack the fields described by fmt out of buf
+		"""
+		out = {}
+		for name, (offset, code) in fmt.items():
+			values = Struct("<" + code).unpack_from(buf, base + offset)
+			out[name] = values if len(values) > 1 else values[0]
+		return out
+
+	@staticmethod
+	def _testBit(bitmap, nr):
+		"""
+		Is bit nr of bitmap set?  (big-endian within bytes)
+		"""
+		return bytearray(bitmap[nr >> 3:(nr >> 3) + 1])[0] & (0x80 >> (nr & 7))
+
+	def _read(self, offset, length):
+		"""
+		Read length bytes at offset of the filesystem
+		"""
+		self.file.seek(offset, io.SEEK_SET)
+		buf = self.file.read(length)
+		if len(buf) != length:
+			raise NoF2FS("Filesystem truncated")
+		return buf
+
+	def _readBlocks(self, block, count=1):
+		"""
+		Read count blocks starting at block
+		"""
+		return self._read(block << self.blockShift, count << self.blockShift)
+
+	def _crc(self, buf):
+		"""
+		F2FS's CRC-32, seeded with the magic number and not inverted
+		"""
+		return zlib.crc32(buf, self._sb_magic ^ 0xFFFFFFFF) & 0xFFFFFFFF ^ 0xFFFFFFFF
+
+	def _cpBlock(self, block):
+		"""
+		Read and check the checkpoint block at block, returns the values
+		and the block, None if it is damaged
+		"""
+
+		buf = self._readBlocks(block)
+		cp = self._unpack(self._cp_fmt, buf)
+
+		offset = cp['checksumOffset']
+		if offset < self._cp_bitmap or offset > self.blockSize - 4:
+			return None
+		if self._crc(buf[:offset]) != Struct("<I").unpack_from(buf, offset)[0]:
+			return None
+
+		return (cp, buf)
+
+	def _checkpoint(self, start):
+		"""
+		Return the checkpoint of the pack at block start, None if it is
+		damaged or incomplete (its first and last blocks must agree)
+		"""
+
+		head = self._cpBlock(start)
+		if not head:
+			return None
+
+		count = head[0]['cpPackTotalBlockCount']
+		if count < 2 or count > 1 << self.logBlocksPerSeg:
+			return None
+
+		tail = self._cpBlock(start + count - 1)
+		if not tail or tail[0]['checkpointVer'] != head[0]['checkpointVer']:
+			return None
+
+		return head
+
+	def _sitBitmap(self, cp, buf):
+		"""
+		Return the bitmap of which copy of each SIT block is current
+		"""
+
+		size = cp['sitVerBitmapBytesize']
+
+		if cp['ckptFlags'] & self.cpLargeNatBitmap:
+			offset = self._cp_bitmap + 4 + cp['natVerBitmapBytesize']
+		elif self.cpPayload:
+			# too large for the checkpoint block, it is in the next
+			return self._readBlocks(self.cpStart + 1)[:size]
+		else:
+			offset = self._cp_bitmap
+
+		return buf[offset:offset + size]
+
+	def _sitJournal(self, cp):
+		"""
+		Return a dict of the SIT entries in the journal, these are newer
+		than the ones in the SIT blocks
+		"""
+
+		entriesInSum = self.blockSize >> 3
+		journalSize = self.blockSize - 5 - 7 * entriesInSum
+
+		if cp['ckptFlags'] & self.cpCompactSum:
+			buf = self._readBlocks(self.cpStart + cp['cpPackStartSum'])
+			offset = journalSize
+		else:
+			buf = self._readBlocks(self.cpStart + cp['cpPackStartSum'] + self._coldData)
+			offset = 7 * entriesInSum
+
+		size = self._sit_journal.size + self._sit_entry.size
+		count = Struct("<H").unpack_from(buf, offset)[0]
+		if count > (journalSize - 2) // size:
+			raise NoF2FS("Bad SIT journal")
+
+		journal = {}
+		for idx in range(count):
+			base = offset + 2 + idx * size
+			segno = self._sit_journal.unpack_from(buf, base)[0]
+			journal[segno] = self._sit_entry.unpack_from(buf, base + self._sit_journal.size)[1]
+
+		return journal
+
+	def usedRuns(self):
+		"""
+		Return a sorted list of (offset, length) in bytes of the areas of
+		the filesystem which are in use, adjacent areas merged
+		"""
+
+		perBlock = self.blockSize // self._sit_entry.size
+		sitBlocks = (self.segmentCountMain + perBlock - 1) // perBlock
+
+		# each SIT block has two copies, the checkpoint says which is
+		# current, read both halves and pick
+		half = (self.segmentCountSit >> 1) << self.logBlocksPerSeg
+		if sitBlocks > half or sitBlocks > len(self.sitBitmap) << 3:
+			raise NoF2FS("SIT area too small")
+		copies = [self._readBlocks(self.sitBlkaddr, sitBlocks), self._readBlocks(self.sitBlkaddr + half, sitBlocks)]
+
+		maps = []
+		for segno in range(self.segmentCountMain):
+			block = segno // perBlock
+			copy = copies[1 if self._testBit(self.sitBitmap, block) else 0]
+			offset = (block << self.blockShift) + (segno % perBlock) * self._sit_entry.size
+			maps.append(self._sit_entry.unpack_from(copy, offset)[1])
+
+		for segno, valid in self.journal.items():
+			if segno >= self.segmentCountMain:
+				raise NoF2FS("Bad SIT journal")
+			maps[segno] = valid
+
+		bitmap = b"".join(maps).translate(_reverseBits)
+		blocks = self.segmentCountMain << self.logBlocksPerSeg
+
+		# everything ahead of the main area is metadata
+		runs = [[0, self.mainBlkaddr]]
+		used = 0
+		for s, e in bitmapRuns(bitmap, blocks):
+			used += e - s
+			s += self.mainBlkaddr
+			e += self.mainBlkaddr
+			if s <= runs[-1][1]:
+				runs[-1][1] = e
+			else:
+				runs.append([s, e])
+
+		# preallocated blocks are counted, yet have no SIT bits
+		if used > self.validBlockCount:
+			raise NoF2FS("SIT doesn't match the checkpoint")
+
+		verbose("{:d} of {:d} main area blocks in use".format(used, blocks))
+
+		return [(s << self.blockShift, (e - s) << self.blockShift) for s, e in runs]
+
+	def __init__(self, file):
+		"""
+		Initialize F2FS from file (seekable, positioned arbitrarily)
+		"""
+
+		super(F2FS, self).__init__()
+
+		self.file = file
+
+		try:
+			buf = self._read(self._sb_offset, self._sb_length)
+		except NoF2FS:
+			raise NoF2FS("Too small for an F2FS filesystem")
+
+		sb = self._unpack(self._sb_fmt, buf)
+
+		if sb['magic'] != self._sb_magic:
+			raise NoF2FS("No F2FS superblock found")
+
+		# the SIT bitmaps cover 512 block segments
+		if sb['logBlockSize'] < 12 or sb['logBlockSize'] > 16 or sb['logBlocksPerSeg'] != 9:
+			raise NoF2FS("Superblock values are implausible")
+
+		self.blockShift = sb['logBlockSize']
+		self.blockSize = 1 << self.blockShift
+		self.logBlocksPerSeg = sb['logBlocksPerSeg']
+		self.blockCount = sb['blockCount']
+		self.segmentCountSit = sb['segmentCountSit']
+		self.segmentCountMain = sb['segmentCountMain']
+		self.sitBlkaddr = sb['sitBlkaddr']
+		self.mainBlkaddr = sb['mainBlkaddr']
+		self.cpPayload = sb['cpPayload']
+
+		if self.mainBlkaddr + (self.segmentCountMain << self.logBlocksPerSeg) > self.blockCount:
+			raise NoF2FS("Superblock values are implausible")
+
+		self.size = self.blockCount << self.blockShift
+
+		# two checkpoint packs, the newer valid one is current
+		best = None
+		for start in sb['cpBlkaddr'], sb['cpBlkaddr'] + (1 << self.logBlocksPerSeg):
+			found = self._checkpoint(start)
+			if found and (not best or found[0]['checkpointVer'] > best[0]['checkpointVer']):
+				best = found
+				self.cpStart = start
+		if not best:
+			raise NoF2FS("No valid checkpoint")
+		cp, buf = best
+
+		# data fsync()ed since the checkpoint would be lost
+		if not cp['ckptFlags'] & self.cpUmount or cp['ckptFlags'] & self.cpDisabled:
+			raise NoF2FS("Filesystem wasn't cleanly unmounted")
+		if cp['ckptFlags'] & (self.cpError | self.cpFsck):
+			raise NoF2FS("Filesystem needs checking")
+
+		self.validBlockCount = cp['validBlockCount']
+		self.sitBitmap = self._sitBitmap(cp, buf)
+		self.journal = self._sitJournal(cp)
+
+		verbose("{:d} blocks of {:d} bytes, checkpoint {:d}".format(self.blockCount, self.blockSize, cp['checkpointVer']))
+
+
+
+if __name__ == "__main__":
+	print("Sorry, this file is an internal library and doesn't do anything interesting by", file=sys.stderr)
+	print("itself.", file=sys.stderr)
+	sys.exit(1)
@@ -289,7 +289,8 @@ class GPT(object):
 		self.slices = []
 		crc = 0
 		for i in range(self.entryCount):
-			sbuf = buf[sliceAddr:sliceAddr+self.entrySize]
+			# trailing zero entries may have been trimmed off
+			sbuf = bytes(buf[sliceAddr:sliceAddr+self.entrySize]).ljust(self.entrySize, b'\x00')
 			crc = crc32(sbuf, crc)
 			slice = GPTSlice(sbuf)
 			self.slices.append(slice)
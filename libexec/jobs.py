@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 Elliott Mitchell <ehem+android@m5p.com>
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import sys
+import threading
+import heapq
+from contextlib import contextmanager
+
+
+def runJobs(func, items, jobs=1):
+	"""
+	Call func() on each of items using up to jobs threads, returns a
+	list of the results in the same order as items.
+
+	The heavy lifting (zlib, hashlib, the copying system calls) releases
+	the GIL, so threads are sufficient.  If a job raises an exception
+	(including the sys.exit() used for errors everywhere) no further
+	jobs are started and it is re-raised in the calling thread.
+	"""
+
+	items = list(items)
+
+	if jobs <= 1 or len(items) <= 1:
+		return [func(item) for item in items]
+
+	results = [None] * len(items)
+	lock = threading.Lock()
+
+	# sigh, Python 2 hack for some variables
+	class nl:
+		next = 0
+		error = None
+
+	def worker():
+		while True:
+			with lock:
+				if nl.error or nl.next >= len(items):
+					return
+				idx = nl.next
+				nl.next += 1
+
+			try:
+				results[idx] = func(items[idx])
+			except BaseException:
+				with lock:
+					if not nl.error:
+						nl.error = sys.exc_info()
+				return
+
+	threads = [threading.Thread(target=worker) for i in range(min(jobs, len(items)))]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	if nl.error:
+		raise nl.error[1]
+
+	return results
+
+
+def simulateJobs(durations, jobs=1):
+	"""
+	Return how long runJobs() with up to jobs threads would take, given
+	how long each item takes.  Like runJobs() the items are handed out
+	in order, each to whichever thread is free first.
+	"""
+
+	free = [0.0] * max(min(jobs, len(durations)), 1)
+
+	for duration in durations:
+		heapq.heappush(free, heapq.heappop(free) + duration)
+
+	return max(free)
+
+
+class Budget(object):
+	"""
+	Limits shared by everything running at once, a number of CPUs and an
+	amount of memory.  Work reserves its share before starting, waiting
+	until enough is free.  Anything larger than the whole budget still
+	runs, just alone.
+	"""
+
+	def acquire(self, cpus=1, memory=0):
+		"""
+		Wait for cpus and memory to be available, then claim them
+		"""
+
+		cpus = min(cpus, self.cpus)
+		memory = min(memory, self.memory)
+
+		with self.cond:
+			while self.usedCpus + cpus > self.cpus or self.usedMemory + memory > self.memory:
+				self.cond.wait()
+			self.usedCpus += cpus
+			self.usedMemory += memory
+
+		return (cpus, memory)
+
+	def release(self, claim):
+		"""
+		Return what an earlier acquire() claimed
+		"""
+
+		with self.cond:
+			self.usedCpus -= claim[0]
+			self.usedMemory -= claim[1]
+			self.cond.notify_all()
+
+	@contextmanager
+	def reserve(self, cpus=1, memory=0):
+		"""
+		Hold cpus and memory for the duration of a with statement
+		"""
+
+		claim = self.acquire(cpus, memory)
+		try:
+			yield claim
+		finally:
+			self.release(claim)
+
+	def __init__(self, cpus=1, memory=None):
+		"""
+		Initialize Budget, memory is in bytes, None is unlimited
+		"""
+
+		super(Budget, self).__init__()
+
+		self.cpus = max(cpus, 1)
+		self.memory = memory if memory != None else float("inf")
+
+		self.usedCpus = 0
+		self.usedMemory = 0
+		self.cond = threading.Condition()
+
+
+
+if __name__ == "__main__":
+	print("Sorry, this file is an internal library and doesn't do anything interesting by", file=sys.stderr)
+	print("itself.", file=sys.stderr)
+	sys.exit(1)
@@ -19,9 +19,11 @@ Copyright (C) 2013 IOMonster (thecubed on XDA)
 """
 
 from __future__ import print_function
+import os
 import sys
 from struct import Struct
 from collections import OrderedDict
+from binascii import b2a_hex
 import dz
 
 
@@ -46,6 +48,117 @@ class KDZFile(dz.DZStruct):
 		('offset',	('Q',    False)),
 	])
 
+	# Known magic numbers and the format version they indicate
+	kdz_header = {
+		b"\x28\x05\x00\x00"b"\x34\x31\x25\x80":	0,
+		b"\x18\x05\x00\x00"b"\x32\x79\x44\x50":	1,
+		_dz_header:				2,
+	}
+
+
+	def readKDZHeader(self):
+		"""
+		Reads the KDZ header, and returns a single kdz_item
+		in the form as defined by self._dz_format_dict
+		"""
+
+		# Read a whole DZ header
+		buf = self.infile.read(self._dz_length)
+
+		# "Make the item"
+		# Create a new dict using the keys from the format string
+		# and the format string itself
+		# and apply the format to the buffer
+		kdz_item = dict(zip(
+			self._dz_format_dict.keys(),
+			self._dz_struct.unpack(buf)
+		))
+
+		# Collapse (truncate) each key's value if it's listed as collapsible
+		for key in self._dz_collapsibles:
+			if type(kdz_item[key]) is str or type(kdz_item[key]) is bytes:
+				kdz_item[key] = kdz_item[key].rstrip(b'\x00')
+				if b'\x00' in kdz_item[key]:
+					print("[!] Error: extraneous data found IN "+key, file=sys.stderr)
+					sys.exit(1)
+			elif type(kdz_item[key]) is int:
+				if kdz_item[key] != 0:
+					print('[!] Error: field "'+key+'" is non-zero ('+b2a_hex(kdz_item[key])+')', file=sys.stderr)
+					sys.exit(1)
+			else:
+				print("[!] Error: internal error", file=sys.stderr)
+				sys.exit(-1)
+
+		return kdz_item
+
+	def getPartitions(self):
+		"""
+		Returns the list of partitions from a KDZ file containing multiple segments
+		"""
+
+		# Setup initial values
+		last = False
+		cont = not last
+		self.dataStart = 1<<63
+
+		while cont:
+
+			# Read the current KDZ header
+			kdz_sub = self.readKDZHeader()
+
+			# Add it to our list
+			self.partitions.append(kdz_sub)
+
+			# Update start of data, if needed
+			if kdz_sub['offset'] < self.dataStart:
+				self.dataStart = kdz_sub['offset']
+
+			# Was it the last one?
+			cont = not last
+
+			# Check for end of headers
+			nextchar = self.infile.read(1)
+			# Is this the last KDZ header? (ctrl-C, how appropos)
+			if nextchar == b'\x03':
+				last = True
+			# Alternative, immediate end
+			elif nextchar == b'\x00':
+				cont = False
+			# Rewind file pointer 1 byte
+			else:
+				self.infile.seek(-1, os.SEEK_CUR)
+
+		# Record where headers end
+		self.headerEnd = self.infile.tell()
+
+		# Paranoia check for an updated file format
+		buf = self.infile.read(self.dataStart - self.headerEnd - 1)
+		if len(buf.lstrip(b'\x00')) > 0:
+			print("[!] Warning: Data between headers and payload! (offsets {:d} to {:d})".format(self.headerEnd, self.dataStart), file=sys.stderr)
+			self.hasExtra = True
+
+		# Make partition list
+		return [(x['name'],x['length']) for x in self.partitions]
+
+	def findDZ(self):
+		"""
+		If our file is a KDZ file, returns the header of the DZ file
+		embedded in it, None if it isn't a KDZ file
+		"""
+
+		self.infile.seek(0, os.SEEK_SET)
+		if self.infile.read(8) not in self.kdz_header:
+			return None
+
+		self.getPartitions()
+
+		for part in self.partitions:
+			if part['name'][-3:] == b".dz":
+				return part
+
+		print("[!] Error: KDZ file contains no DZ file!", file=sys.stderr)
+		sys.exit(1)
+
 
 	def __init__(self):
 		"""
@@ -53,3 +166,5 @@ class KDZFile(dz.DZStruct):
 		"""
 		super(KDZFile, self).__init__(KDZFile)
 
+		self.partitions = []
+
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 Elliott Mitchell <ehem+android@m5p.com>
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import io
+import hashlib
+import threading
+from collections import deque
+
+
+class ManifestFile(object):
+	"""
+	Wrapper for an output file, passes everything written on to the
+	manifest for hashing
+	"""
+
+	def write(self, buf):
+		"""
+		Write buf to the file, queue what was written for hashing
+		"""
+
+		count = self.file.write(buf)
+		# buffered files return None on Python 2
+		if count == None:
+			count = len(buf)
+
+		# bytes are immutable, anything else has to be copied
+		if type(buf) is not bytes or count != len(buf):
+			buf = bytes(buf[:count])
+
+		self.manifest.update(self.name, buf, self.pos)
+		self.pos += count
+
+		return count
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		"""
+		Seek the file, track our position
+		"""
+		self.file.seek(offset, whence)
+		self.pos = self.file.tell()
+		return self.pos
+
+	def tell(self):
+		"""
+		Return our position
+		"""
+		return self.pos
+
+	def truncate(self, size=None):
+		"""
+		Truncate the file, informing the manifest
+		"""
+		if size == None:
+			size = self.pos
+		self.file.truncate(size)
+		self.manifest.truncate(self.name, size)
+		return size
+
+	def flush(self):
+		"""
+		Flush the underlying file
+		"""
+		self.file.flush()
+
+	def fileno(self):
+		"""
+		Return the underlying descriptor
+		"""
+		return self.file.fileno()
+
+	def close(self):
+		"""
+		Close the file, the manifest entry is complete
+		"""
+		size = self.file.seek(0, io.SEEK_END)
+		self.file.close()
+		self.manifest.finish(self.name, size)
+
+	def __init__(self, manifest, file, name):
+		"""
+		Initialize ManifestFile, wrapping file which will appear in the
+		manifest as name
+		"""
+
+		super(ManifestFile, self).__init__()
+
+		self.manifest = manifest
+		self.file = file
+		self.name = name
+		self.pos = file.tell()
+
+		manifest.start(name, os.path.abspath(file.name if hasattr(file, "name") and not isinstance(file.name, int) else name))
+
+		# pre-existing contents which won't be overwritten?
+		if file.seek(0, io.SEEK_END) > 0:
+			manifest.truncate(name, -1)
+		file.seek(self.pos, io.SEEK_SET)
+
+
+
+class Manifest(object):
+	"""
+	SHA-256 manifest of output files.  The data is handed over as it is
+	written and hashed on a helper thread, so extraction neither waits
+	on the hashing nor needs a second pass over the output.  Files which
+	aren't written sequentially get hashed from storage once complete.
+	"""
+
+	# Limit on data waiting to be hashed, to bound memory use
+	maxPending = 256<<20
+
+	# Zeros for hashing holes
+	_zeros = bytes(bytearray(1<<20))
+
+	def _hashZeros(self, entry, count):
+		"""
+		Hash count zero bytes into entry
+		"""
+		while count > 0:
+			entry['hash'].update(self._zeros[:count])
+			count -= len(self._zeros)
+
+	def _process(self, op, name, buf, value):
+		"""
+		Handle one queued operation, on the helper thread
+		"""
+
+		entry = self.entries[name]
+
+		if op == "data":
+			if entry['dirty']:
+				return
+			if value < entry['pos']:
+				entry['dirty'] = True
+				return
+			self._hashZeros(entry, value - entry['pos'])
+			entry['hash'].update(buf)
+			entry['pos'] = value + len(buf)
+
+		elif op == "truncate":
+			if value < entry['pos']:
+				entry['dirty'] = True
+
+		elif op == "finish":
+			if entry['dirty'] or entry['pos'] > value:
+				entry['hash'] = hashlib.sha256()
+				file = io.open(entry['path'], "rb")
+				buf = file.read(1<<20)
+				while len(buf) > 0:
+					entry['hash'].update(buf)
+					buf = file.read(1<<20)
+				file.close()
+			else:
+				self._hashZeros(entry, value - entry['pos'])
+			entry['digest'] = entry['hash'].hexdigest()
+			del entry['hash']
+
+	def _worker(self):
+		"""
+		Helper thread, hash everything queued
+		"""
+
+		while True:
+			with self.cond:
+				while len(self.queue) == 0:
+					self.cond.wait()
+				item = self.queue.popleft()
+
+			if item == None:
+				return
+
+			try:
+				if not self.error:
+					self._process(*item)
+			except BaseException:
+				self.error = sys.exc_info()
+
+			with self.cond:
+				if item[2] != None:
+					self.pending -= len(item[2])
+				self.cond.notify_all()
+
+	def _queue(self, item):
+		"""
+		Queue an operation for the helper thread, waiting if too much
+		data is already pending
+		"""
+
+		with self.cond:
+			size = len(item[2]) if item and item[2] != None else 0
+			while self.pending > 0 and self.pending + size > self.maxPending:
+				self.cond.wait()
+			self.pending += size
+			self.queue.append(item)
+			self.cond.notify_all()
+
+	def start(self, name, path):
+		"""
+		Begin a manifest entry for name, stored at path
+		"""
+		with self.cond:
+			self.entries[name] = {
+				'hash':		hashlib.sha256(),
+				'pos':		0,
+				'path':		path,
+				'dirty':	False,
+			}
+
+	def update(self, name, buf, offset):
+		"""
+		Queue buf, written at offset, for hashing.  buf must not be
+		modified afterwards.
+		"""
+		self._queue(("data", name, buf, offset))
+
+	def truncate(self, name, size):
+		"""
+		Note truncation of name to size
+		"""
+		self._queue(("truncate", name, None, size))
+
+	def finish(self, name, size):
+		"""
+		The file name is complete, with the given size
+		"""
+		self._queue(("finish", name, None, size))
+
+	def wrap(self, file, name):
+		"""
+		Return a wrapper around file, which is name in the manifest
+		"""
+		return ManifestFile(self, file, name)
+
+	def close(self):
+		"""
+		Wait for hashing to complete, then write the manifest (in the
+		format of sha256sum, for use with "sha256sum -c")
+		"""
+
+		self._queue(None)
+		self.thread.join()
+
+		if self.error:
+			raise self.error[1]
+
+		out = io.open(self.name, "wt")
+		for name in sorted(self.entries.keys()):
+			out.write(u"{:s}  {:s}\n".format(self.entries[name]['digest'], name))
+		out.close()
+
+		print("[+] Wrote SHA-256 manifest of {:d} files to {:s}".format(len(self.entries), self.name))
+
+	def __init__(self, name):
+		"""
+		Initialize Manifest, to be written to the file name
+		"""
+
+		super(Manifest, self).__init__()
+
+		self.name = os.path.abspath(name)
+		self.entries = {}
+		self.error = None
+
+		self.queue = deque()
+		self.pending = 0
+		self.cond = threading.Condition()
+
+		self.thread = threading.Thread(target=self._worker)
+		self.thread.daemon = True
+		self.thread.start()
+
+
+
+if __name__ == "__main__":
+	print("Sorry, this file is an internal library and doesn't do anything interesting by", file=sys.stderr)
+	print("itself.", file=sys.stderr)
+	sys.exit(1)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2016 Elliott Mitchell <ehem+android@m5p.com>
+
+	This program is free software: you can redistribute it and/or modify
+	it under the terms of the GNU General Public License as published by
+	the Free Software Foundation, either version 3 of the License, or
+	(at your option) any later version.
+
+	This program is distributed in the hope that it will be useful,
+	but WITHOUT ANY WARRANTY; without even the implied warranty of
+	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+	GNU General Public License for more details.
+
+	You should have received a copy of the GNU General Public License
+	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import print_function
+import sys
+import zlib
+from struct import Struct
+
+import jobs
+
+
+# Modulus used by Adler-32
+_adlerBase = 65521
+
+# Deflate window, the amount of history usable as dictionary
+_window = 1<<15
+
+# zlib stream trailer, Adler-32 in network order
+_trailer = Struct(">I")
+
+
+def adler32Combine(adler1, adler2, len2):
+	"""
+	Combine the Adler-32 of two pieces of data into the Adler-32 of
+	their concatenation, len2 is the length of the second piece (a
+	port of zlib's adler32_combine())
+	"""
+
+	rem = len2 % _adlerBase
+	sum1 = adler1 & 0xFFFF
+	sum2 = (rem * sum1) % _adlerBase
+	sum1 += (adler2 & 0xFFFF) + _adlerBase - 1
+	sum2 += (adler1 >> 16) + (adler2 >> 16) + _adlerBase - rem
+	if sum1 >= _adlerBase:
+		sum1 -= _adlerBase
+	if sum1 >= _adlerBase:
+		sum1 -= _adlerBase
+	if sum2 >= _adlerBase << 1:
+		sum2 -= _adlerBase << 1
+	if sum2 >= _adlerBase:
+		sum2 -= _adlerBase
+	return sum1 | (sum2 << 16)
+
+
+def zlibHeader(level):
+	"""
+	Return the two byte zlib stream header zlib itself would use for
+	the compression level
+	"""
+
+	if level == 0 or level == 1:
+		flevel = 0
+	elif level < 6:
+		flevel = 1
+	elif level == 6 or level == -1:
+		flevel = 2
+	else:
+		flevel = 3
+
+	header = (0x78 << 8) | (flevel << 6)
+	header += 31 - header % 31
+
+	return bytes(bytearray([header >> 8, header & 0xFF]))
+
+
+def deflateBlock(level, data, dictionary, last):
+	"""
+	Raw deflate one block, primed with the history of the preceeding
+	block.  Unless last the output ends on a byte boundary (sync flush)
+	so the blocks can simply be concatenated.  Returns the compressed
+	data and the Adler-32 of data.
+	"""
+
+	zobj = None
+	if dictionary:
+		# Python 2 lacks zdict, the stream is fine, just a bit larger
+		try:
+			zobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+		except TypeError:
+			pass
+	if not zobj:
+		zobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+	zdata = zobj.compress(data) + zobj.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+	return zdata, zlib.adler32(data) & 0xFFFFFFFF
+
+
+class ParallelCompress(object):
+	"""
+	Stand-in for zlib.compressobj() which splits the input into blocks
+	and deflates several of them at once, in the manner of pigz.  Each
+	block is primed with the tail of the preceeding one and the pieces
+	are stitched into a single ordinary zlib stream, with the Adler-32
+	combined from the per-block values.
+	"""
+
+	def _deflate(self, blocks, last):
+		"""
+		Compress a batch of blocks concurrently, returns the output
+		"""
+
+		work = []
+		dictionary = self.dictionary
+		for block in blocks:
+			work.append((block, dictionary))
+			dictionary = block[-_window:]
+		self.dictionary = dictionary
+
+		count = len(work)
+		results = jobs.runJobs(lambda idx: deflateBlock(self.level, work[idx][0], work[idx][1], last and idx == count - 1), range(count), self.workers)
+
+		out = [self.header]
+		self.header = b""
+		for (block, dictionary), (zdata, adler) in zip(work, results):
+			self.adler = adler32Combine(self.adler, adler, len(block))
+			out.append(zdata)
+
+		return b"".join(out)
+
+	def compress(self, data):
+		"""
+		Add data to be compressed, returns any compressed data ready
+		"""
+
+		self.input += data
+
+		batch = self.blockSize * self.workers
+		if len(self.input) < batch:
+			return b""
+
+		count = (len(self.input) // self.blockSize) * self.blockSize
+		blocks = [bytes(self.input[i:i + self.blockSize]) for i in range(0, count, self.blockSize)]
+		del self.input[:count]
+
+		return self._deflate(blocks, False)
+
+	def flush(self, mode=zlib.Z_FINISH):
+		"""
+		Finish the stream, returns the remaining compressed data
+		"""
+
+		blocks = [bytes(self.input[i:i + self.blockSize]) for i in range(0, len(self.input), self.blockSize)]
+		self.input = bytearray()
+
+		if len(blocks) == 0:
+			blocks = [b""]
+
+		return self._deflate(blocks, True) + _trailer.pack(self.adler)
+
+	def __init__(self, level=1, workers=1, blockSize=1<<20):
+		"""
+		Initialize ParallelCompress, blocks of blockSize are compressed
+		by up to workers threads
+		"""
+
+		super(ParallelCompress, self).__init__()
+
+		self.level = level
+		self.workers = max(workers, 1)
+		self.blockSize = blockSize
+
+		self.input = bytearray()
+		self.dictionary = None
+		self.adler = zlib.adler32(b"") & 0xFFFFFFFF
+		self.header = zlibHeader(level)
+
+
+
+if __name__ == "__main__":
+	print("Sorry, this file is an internal library and doesn't do anything interesting by", file=sys.stderr)
+	print("itself.", file=sys.stderr)
+	sys.exit(1)
@@ -30,6 +30,10 @@ from binascii import a2b_hex
 sys.path.append(os.path.join(sys.path[0], "libexec"))
 
 import dz
+import copyrange
+import jobs
+
+import image2chunks
 
 
 class MKDZChunk(dz.DZChunk):
@@ -62,21 +66,24 @@ class MKDZChunk(dz.DZChunk):
 		"""
 		print("{:2d} : {:s}".format(index, self.chunkName))
 
-	def write(self, file, name):
+	def getSize(self):
 		"""
-		Write our block to the file with the specified name
+		Return the size of our .chunk file
 		"""
-		input = io.FileIO(self.name, "rb")
+		return self.size
 
-		l = input.seek(0, io.SEEK_END)
-		input.seek(0, io.SEEK_SET)
+	def write(self, file, name, offset):
+		"""
+		Write our block to the file with the specified name, at offset
+		"""
+		input = io.FileIO(self.name, "rb")
 
-		print("[+] Writing {:s} to {:s} ({:d} bytes)".format(self.name, name, l))
+		print("[+] Writing {:s} to {:s} ({:d} bytes)".format(os.path.basename(self.name), name, self.size))
 
-		buf = b" "
-		while len(buf) > 0:
-			buf = input.read(4096)
-			file.write(buf)
+		# the kernel does the copying if it can
+		if copyrange.copyRange(input, file, 0, offset, self.size) != self.size:
+			print("[!] Error: {:s} changed while being written".format(self.name), file=sys.stderr)
+			sys.exit(1)
 
 		input.close()
 
@@ -93,6 +100,8 @@ class MKDZChunk(dz.DZChunk):
 
 		self.buffer = file.read(self._dz_length)
 
+		self.size = os.fstat(file.fileno()).st_size
+
 		dz_item = self.unpackdict(self.buffer)
 
 		self.chunkName = dz_item['chunkName'].rstrip(b'\x00').decode("utf8")
@@ -110,6 +119,45 @@ class MKDZChunk(dz.DZChunk):
 		file.close()
 
 
+class MKDZImageChunk(MKDZChunk):
+	"""
+	A chunk which hasn't been compressed yet, it is compressed from the
+	image straight into the DZ file when written
+	"""
+
+	def write(self, file, name, offset):
+		"""
+		Compress our block into the file with the specified name, at offset
+		"""
+
+		self.buffer = self.image.writeChunk(self.item, file, offset)
+
+		self.size = self._dz_length + self.unpackdict(self.buffer)['dataSize']
+
+	def __init__(self, image, item):
+		"""
+		Initialize MKDZImageChunk, item is from the plan for image
+		"""
+
+		# skip MKDZChunk's, there is no .chunk file to read
+		dz.DZChunk.__init__(self)
+
+		self.image = image
+		self.item = item
+
+		self.start = image.startLBA + (item[0] >> image.blockShift)
+		self.end = self.start + item[2]
+		self.dev = image.dev
+
+		self.chunkName = image.baseName + str(self.start) + ".bin"
+
+		self.name = os.path.join(image.dirName, self.chunkName)
+
+		# known once written
+		self.buffer = None
+		self.size = None
+
+
 class MKDZFile(dz.DZFile):
 	"""
 	Representation of the whole file/header from a LGE DZ file
@@ -123,7 +171,7 @@ class MKDZFile(dz.DZFile):
 		"""
 
 		params = dict()
-		file = io.open(".dz.params", "rt")
+		file = io.open(os.path.join(self.dirname, ".dz.params"), "rt")
 		line = file.readline()
 		while len(line) > 0:
 			line.lstrip()
@@ -188,9 +236,36 @@ class MKDZFile(dz.DZFile):
 		Scan directory for .chunk files, load them
 		"""
 
-		for name in os.listdir("."):
+		for name in os.listdir(self.dirname):
 			if name[-6:] == ".chunk":
-				self.chunks.append(MKDZChunk(name, self.blockShift))
+				self.chunks.append(MKDZChunk(os.path.join(self.dirname, name), self.blockShift))
+
+		self.sortChunks()
+
+	def loadImages(self, workers):
+		"""
+		Scan directory for .image files, plan their chunks (automatically
+		picking how), the chunks are compressed as the DZ file is written
+		"""
+
+		names = sorted(name for name in os.listdir(self.dirname) if name[-6:] == ".image")
+
+		budget = jobs.Budget(workers)
+
+		# split mode keeps the workers busy while the chunks are done
+		# one at a time
+		images = jobs.runJobs(lambda name: image2chunks.Image2Chunks(os.path.join(self.dirname, name), 3, workers, workers > 1, budget=budget, planOnly=True), names, workers)
+
+		for image in images:
+			for item in image.plan:
+				self.chunks.append(MKDZImageChunk(image, item))
+
+		self.sortChunks()
+
+	def sortChunks(self):
+		"""
+		Put the chunks in the order they're written
+		"""
 
 		self.chunks.sort(key=lambda c: (c.getStart() + (c.getDev()<<48) + (1<<56 if c.chunkName[-4:] == ".img" else 0)))
 
@@ -235,47 +310,118 @@ class MKDZFile(dz.DZFile):
 			chunk.list(index)
 			index += 1
 
-	def writeFile(self, file, name):
+	def getSize(self):
 		"""
-		Write our created file to storage as the named file
+		Return the size of the file we create
 		"""
+		return self._dz_length + sum(chunk.getSize() for chunk in self.chunks)
 
-		print("[+] Writing {:d} chunks to {:s}:".format(len(self.chunks), name))
-		print()
+	def packHeader(self):
+		"""
+		Return our header, once the chunk headers are all known
+		"""
 
 		self.dz_item['md5'] = self.md5Header
 		self.dz_item['chunkCount'] = len(self.chunks)
 
 		# this date code looks like an integer, but is really a string!
-		self.dz_item['oldDateCode'] = str(self.dz_item['oldDateCode'])
+		if not hasattr(self.dz_item['oldDateCode'], "decode"):
+			self.dz_item['oldDateCode'] = str(self.dz_item['oldDateCode']).encode("utf8")
 
-		buffer = self.packdict(self.dz_item)
+		return self.packdict(self.dz_item)
 
-		file.write(buffer)
+	def writeImages(self, file, name, base=0):
+		"""
+		Compress the chunks of our images straight into the file, one
+		after another since their sizes aren't known in advance.  Like
+		writeFile() the header goes in last.
+		"""
+
+		print("[+] Compressing {:d} chunks into {:s}:".format(len(self.chunks), name))
+		print()
+
+		md5 = hashlib.md5()
 
+		offset = base + self._dz_length
 		for chunk in self.chunks:
-			chunk.write(file, name)
+			chunk.write(file, name, offset)
+			md5.update(chunk.buffer)
+			offset += chunk.getSize()
+
+		self.md5Header = md5.digest()
+
+		file.seek(base, io.SEEK_SET)
+		file.write(self.packHeader())
+
+	def writeFile(self, file, name, workers=1, base=0):
+		"""
+		Write our created file to storage as the named file, starting at
+		base (it may be inside a larger file).  Every chunk's place is
+		known in advance, so up to workers of them are copied in at
+		once, the header goes in last.
+		"""
+
+		if self.fromImages:
+			return self.writeImages(file, name, base)
 
-	def __init__(self, dirname):
+		print("[+] Writing {:d} chunks to {:s}:".format(len(self.chunks), name))
+		print()
+
+		buffer = self.packHeader()
+
+		# lay out the chunks
+		offsets = []
+		offset = base + len(buffer)
+		for chunk in self.chunks:
+			offsets.append(offset)
+			offset += chunk.getSize()
+
+		# the size is known, so the space can be allocated up front
+		try:
+			os.posix_fallocate(file.fileno(), base, offset - base)
+		except (AttributeError, OSError):
+			if os.fstat(file.fileno()).st_size < offset:
+				os.ftruncate(file.fileno(), offset)
+
+		def copy(idx):
+			# sendfile() and Python 2 move the position, so each
+			# thread needs its own handle on the output
+			out = io.FileIO(file.name, "r+b") if workers > 1 else file
+			self.chunks[idx].write(out, name, offsets[idx])
+			if out is not file:
+				out.close()
+
+		jobs.runJobs(copy, range(len(self.chunks)), workers)
+
+		# until now an interrupted file isn't mistaken for a good one
+		file.seek(base, io.SEEK_SET)
+		file.write(buffer)
+
+	def __init__(self, dirname, fromImages=False, workers=1):
 		"""
-		Initialize MKDZFile, the data for the overal DZ file
+		Initialize MKDZFile, the data for the overal DZ file, either from
+		.chunk files or from the .image files they would be made from
 		"""
 
 		super(MKDZFile, self).__init__()
 
 		self.dirname = dirname
-
-		os.chdir(dirname)
+		self.fromImages = fromImages
 
 		self.loadParams()
 
 		self.chunks = []
 
-		self.loadChunks()
+		if fromImages:
+			self.loadImages(workers)
+		else:
+			self.loadChunks()
 
 		self.checkChunks()
 
-		self.computeChecksums()
+		# the chunk headers aren't known until they're compressed
+		if not fromImages:
+			self.computeChecksums()
 
 
 
@@ -293,10 +439,10 @@ class MKDZFileTools:
 		"""
 		self.dz_file.listChunks()
 
-	def cmdCreateFile(self, file, name):
+	def cmdCreateFile(self, file, name, workers):
 		"""
 		"""
-		self.dz_file.writeFile(file, os.path.basename(name))
+		self.dz_file.writeFile(file, os.path.basename(name), workers)
 
 	def parseArgs(self):
 		# Parse arguments
@@ -306,6 +452,8 @@ class MKDZFileTools:
 		group.add_argument('-l', '--list', help='list slices/partitions', action='store_true', dest='listOnly')
 		group.add_argument('-m', '--make', help='make DZ file from chunks in directory', action='store_true', dest='createFile')
 		parser.add_argument('-d', '--dir', help='input location', action='store', dest='indir')
+		parser.add_argument('-j', '--jobs', help='number of chunks to copy in concurrently (threads compressing, with --from-images)', action='store', dest='jobs', type=int, default=1)
+		parser.add_argument('-i', '--from-images', help='compress the chunks from the .image files in the directory while writing, instead of using .chunk files', action='store_true', dest='fromImages')
 #		parser.add_argument('-b', '--blocksize', help='blocksize used on the device', action='store', dest='blocksize')
 
 		return parser.parse_args()
@@ -337,7 +485,7 @@ class MKDZFileTools:
 #				shift>>=1
 #			self.shiftLBA = result
 
-		self.dz_file = MKDZFile(self.indir)
+		self.dz_file = MKDZFile(self.indir, args.fromImages, args.jobs)
 
 		if args.listOnly:
 			self.cmdListChunks()
@@ -346,7 +494,7 @@ class MKDZFileTools:
 		# Extracting chunk(s)
 		if args.createFile:
 			file = io.FileIO(os.path.join(cwd, args.dzfile), "wb")
-			self.cmdCreateFile(file, args.dzfile)
+			self.cmdCreateFile(file, args.dzfile, args.jobs)
 			file.close()
 
 
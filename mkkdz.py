@@ -20,12 +20,17 @@ Copyright (C) 2016 Elliott Mitchell <ehem+android@m5p.com>
 from __future__ import print_function
 import os
 import sys
+import io
 import argparse
 
 # our tools are in "libexec"
 sys.path.append(os.path.join(sys.path[0], "libexec"))
 
 import kdz
+import copyrange
+
+# the DZ can be built straight into place
+import mkdz
 
 
 class KDZFileTools(kdz.KDZFile):
@@ -35,6 +40,12 @@ class KDZFileTools(kdz.KDZFile):
 
 	indir = "kdzextracted"
 
+	# directory of .chunk files to build the DZ payload from
+	dzdir = None
+
+	# number of chunks to copy in concurrently
+	jobs = 1
+
 #kdz.KDZFile._dz_header
 
 
@@ -95,20 +106,34 @@ class KDZFileTools(kdz.KDZFile):
 		Create the specified KDZ file
 		"""
 
-		out = open(self.kdzfile, "wb")
+		out = io.FileIO(self.kdzfile, "wb")
 		current = self.dataStart
-		out.seek(current, os.SEEK_SET)
+
+		dzfile = None
 
 		for name in self.payload:
-			print("[+] Writing {:s} to output file {:s}".format(name, self.kdzfile))
-			inf = open(os.path.join(self.indir, name), "rb")
-			buf = " "
-			while len(buf) > 0:
-				buf = inf.read(4096)
-				out.write(buf)
-			self.files[name] = [current, out.tell() - current]
-			inf.close()
-			current = out.tell()
+			# the DZ goes straight into its place, no intermediate file
+			if self.dzdir and not dzfile and name[-3:] == ".dz":
+				print("[+] Building {:s} from {:s} in output file {:s}".format(name, self.dzdir, self.kdzfile))
+				dzfile = mkdz.MKDZFile(self.dzdir)
+				dzfile.writeFile(out, name, self.jobs, current)
+				length = dzfile.getSize()
+
+			else:
+				print("[+] Writing {:s} to output file {:s}".format(name, self.kdzfile))
+				inf = io.FileIO(os.path.join(self.indir, name), "rb")
+				length = os.fstat(inf.fileno()).st_size
+				if copyrange.copyRange(inf, out, 0, current, length) != length:
+					print("[!] Error: {:s} changed while being written".format(name), file=sys.stderr)
+					sys.exit(1)
+				inf.close()
+
+			self.files[name] = [current, length]
+			current += length
+
+		if self.dzdir and not dzfile:
+			print("[!] No DZ file to build from {:s}".format(self.dzdir), file=sys.stderr)
+			sys.exit(1)
 
 		self.files[self.headers[-1]].append(0)
 
@@ -142,6 +167,8 @@ class KDZFileTools(kdz.KDZFile):
 		group.add_argument('-l', '--list', help='list partitions', action='store_true', dest='listOnly')
 		group.add_argument('-m', '--make', help='extract all partitions', action='store_true', dest='createFile')
 		parser.add_argument('-d', '--dir', help='input directory', action='store', dest='indir')
+		parser.add_argument('-z', '--dz-dir', help='build the DZ file from the .chunk files in this directory, instead of reading it from the input directory', action='store', dest='dzdir')
+		parser.add_argument('-j', '--jobs', help='number of chunks to copy in concurrently', action='store', dest='jobs', type=int, default=1)
 
 		return parser.parse_args()
 
@@ -152,6 +179,9 @@ class KDZFileTools(kdz.KDZFile):
 		if args.indir:
 			self.indir = args.indir
 
+		self.dzdir = args.dzdir
+		self.jobs = args.jobs
+
 		self.loadParams()
 
 		if args.listOnly:
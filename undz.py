@@ -33,6 +33,17 @@ sys.path.append(os.path.join(sys.path[0], "libexec"))
 
 import dz
 import gpt
+import kdz
+import manifest
+import jobs
+
+# compatibility, zlib's crc32() releases the GIL (allowing parallel
+# checksumming), but under Python 2 it won't accept a bytearray
+try:
+	zcrc32 = zlib.crc32
+	zcrc32(bytearray(1))
+except TypeError:
+	zcrc32 = crc32
 
 
 class UNDZUtils(object):
@@ -98,6 +109,9 @@ class UNDZChunk(dz.DZChunk, UNDZUtils):
 	Representation of an individual file chunk from a LGE DZ file
 	"""
 
+	# Size of reads when verifying against an image
+	_verifySize = 8<<20
+
 
 	def getChunkName(self):
 		"""
@@ -264,6 +278,60 @@ class UNDZChunk(dz.DZChunk, UNDZUtils):
 		# Print our messages
 		self.Messages()
 
+	def verify(self, name, zeroEnd=None):
+		"""
+		Verify the target area of the raw image/dump in the file name
+		against the MD5 and CRC32 from our header, nothing needs to be
+		decompressed.  If zeroEnd is given, the TRIM area following
+		our data up to zeroEnd must read as zeros.  Returns a list of
+		problems found.
+		"""
+
+		problems = []
+
+		file = io.FileIO(name, "rb")
+		buf = bytearray(min(self._verifySize, max(self.targetSize, 1<<self.dz.shiftLBA)))
+		view = memoryview(buf)
+
+		md5 = hashlib.md5()
+		crc = zcrc32(b"")
+
+		file.seek(self.getTargetStart(), io.SEEK_SET)
+		remaining = self.targetSize
+		while remaining > 0:
+			count = file.readinto(view[:min(remaining, len(buf))])
+			if not count:
+				problems.append("image ends before data does")
+				break
+			data = buf if count == len(buf) else buf[:count]
+			md5.update(data)
+			crc = zcrc32(data, crc)
+			remaining -= count
+
+		crc &= 0xFFFFFFFF
+
+		if remaining <= 0:
+			if crc != self.crc32:
+				problems.append("CRC32 of data doesn't match header ({:08X} vs {:08X})".format(crc, self.crc32))
+			if md5.digest() != self.md5:
+				problems.append("MD5 of data doesn't match header ({:32s} vs {:32s})".format(md5.hexdigest(), b2a_hex(self.md5).decode("utf8")))
+
+		current = self.getTargetEnd()
+		zeros = bytes(bytearray(len(buf)))
+		while zeroEnd and current < zeroEnd:
+			count = file.readinto(view[:min(zeroEnd - current, len(buf))])
+			if not count:
+				break
+			if (buf if count == len(buf) else buf[:count]) != zeros[:count]:
+				first = current + count - len(buf[:count].lstrip(b'\x00'))
+				problems.append("TRIM area doesn't read as zeros (block {:d})".format(first >> self.dz.shiftLBA))
+				break
+			current += count
+
+		file.close()
+
+		return problems
+
 	def __init__(self, dz, file):
 		"""
 		Loads the DZ header in the form as defined by self._dz_chunk_dict
@@ -483,9 +551,34 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 	"""
 
 
-	def open(self, name):
+	def findKDZWindow(self):
+		"""
+		If our file is actually a KDZ, locate the embedded DZ file via
+		the KDZ headers and narrow our window to it
+		"""
+
+		container = kdz.KDZFile()
+		container.infile = self.dzfile
+		part = container.findDZ()
+
+		# Plain DZ file, nothing to do
+		if not part:
+			self.dzfile.seek(self.start, io.SEEK_SET)
+			return
+
+		print("[+] Using {:s} embedded in KDZ file (offset {:d})".format(part['name'].decode("utf8"), part['offset']), file=sys.stderr)
+
+		self.start = part['offset']
+		self.length = part['length']
+		self.dzfile.seek(self.start, io.SEEK_SET)
+
+	def open(self, name, offset=0, length=None):
 		"""
 		What do you expect? Open file and check the header
+
+		offset and length allow the DZ file to be a window over a
+		larger file (such as a KDZ), if neither is given and the file
+		is a KDZ the embedded DZ file is located automatically
 		"""
 
 		# Open the file
@@ -496,8 +589,16 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 			sys.exit(1)
 
 		# Get length of whole file
-		self.length = self.dzfile.seek(0, io.SEEK_END)
-		self.dzfile.seek(0, io.SEEK_SET)
+		self.start = offset
+		if length == None:
+			self.length = self.dzfile.seek(0, io.SEEK_END) - offset
+		else:
+			self.length = length
+
+		if offset == 0 and length == None:
+			self.findKDZWindow()
+		else:
+			self.dzfile.seek(self.start, io.SEEK_SET)
 
 
 		# Load the header, does common checking
@@ -575,7 +676,7 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 			# Would seeking the file to the end of the compressed
 			# data bring us to the end of the file, or beyond it?
 			next = chunk.getNext()
-			if next >= int(self.length):
+			if next >= self.start + self.length:
 				break
 
 			# Seek to next DZ header
@@ -798,6 +899,46 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 			chunk.extractChunk(file, name)
 
 
+	def verify(self, name, checkZeros=False, workers=1):
+		"""
+		Verify a raw image or device dump in the file name against the
+		checksums in the chunk headers, checking several chunks at once.
+		Optionally check TRIMmed areas read back as zeros.  Returns the
+		number of chunks which failed.
+		"""
+
+		file = io.FileIO(name, "rb")
+		length = file.seek(0, io.SEEK_END)
+		file.close()
+
+		# A dump is of a single flash device
+		chunks = [c for c in self.chunks if c.getDev() == 0]
+		if len(chunks) != len(self.chunks):
+			print("[ ] Skipping {:d} chunks for other flash devices".format(len(self.chunks) - len(chunks)))
+
+		# The TRIM area ends where the next chunk's data starts
+		zeroEnds = []
+		for idx in range(len(chunks)):
+			chunk = chunks[idx]
+			end = chunk.getTargetStart() + (chunk.trimCount << self.shiftLBA)
+			if idx + 1 < len(chunks):
+				end = min(end, chunks[idx + 1].getTargetStart())
+			end = min(end, length)
+			zeroEnds.append(end if checkZeros and end > chunk.getTargetEnd() else None)
+
+		results = jobs.runJobs(lambda idx: chunks[idx].verify(name, zeroEnds[idx]), range(len(chunks)), workers)
+
+		failed = 0
+		for chunk, problems in zip(chunks, results):
+			if problems:
+				failed += 1
+				for problem in problems:
+					print("[!] {:s}: {:s}".format(chunk.getChunkName(), problem))
+			else:
+				print("[+] {:s}: OK".format(chunk.getChunkName()))
+
+		return failed
+
 	def saveHeader(self, name):
 		"""
 		Dump the header from the original file into the output dir
@@ -834,9 +975,10 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 		params.close()
 
 
-	def __init__(self, name):
+	def __init__(self, name, offset=0, length=None):
 		"""
-		Constructing this class opens the file and loads map of chunks
+		Constructing this class opens the file and loads map of chunks,
+		optionally from a window of offset/length within the file
 		"""
 
 		super(UNDZFile, self).__init__()
@@ -869,7 +1011,7 @@ class UNDZFile(dz.DZFile, UNDZUtils):
 #		self.crcAll = crc32(b"")
 #		# try crc32 ?
 
-		self.open(name)
+		self.open(name, offset, length)
 		self.loadChunks()
 		self.checkValues()
 
@@ -883,18 +1025,29 @@ class DZFileTools:
 
 	# Setup variables
 	outdir = "dzextracted"
+	manifest = None
+
+	def hashed(self, file, name):
+		"""
+		Hook the output file into the manifest, if one is being made
+		"""
+		return self.manifest.wrap(file, name) if self.manifest else file
 
 	def parseArgs(self):
 		# Parse arguments
 		parser = argparse.ArgumentParser(description='LG Compressed DZ File Extractor originally by IOMonster')
-		parser.add_argument('-f', '--file', help='DZ File to read', action='store', required=True, dest='dzfile')
+		parser.add_argument('-f', '--file', help='DZ File to read (or KDZ file containing one)', action='store', required=True, dest='dzfile')
 		group = parser.add_mutually_exclusive_group(required=True)
 		group.add_argument('-l', '--list', help='list slices/partitions', action='store_true', dest='listOnly')
 		group.add_argument('-x', '--extract', help='extract chunk-file(s) for reconstruction (all by default)', action='store_true', dest='extractChunkfile')
 		group.add_argument('-c', '--chunk', help='extract data chunk(s) (all by default)', action='store_true', dest='extractChunk')
 		group.add_argument('-s', '--single', help='extract diskslice(s) (partition(s)) (all by default)', action='store_true', dest='extractSlice')
 		group.add_argument('-i', '--image', help='extract all slices/partitions as a disk image', action='store_true', dest='extractImage')
+		group.add_argument('-V', '--verify', help='verify raw image or device dump against the DZ, no decompression needed', action='store', dest='verifyFile')
+		parser.add_argument('-z', '--zeros', help='when verifying, also check TRIM areas read as zeros', action='store_true', dest='checkZeros')
+		parser.add_argument('-j', '--jobs', help='number of chunks to verify concurrently', action='store', dest='jobs', type=int, default=1)
 		parser.add_argument('-d', '--dir', '-o', '--out', help='output location', action='store', dest='outdir')
+		parser.add_argument('-M', '--manifest', help='write SHA-256 manifest of extracted files', action='store', dest='manifest')
 
 		return parser.parse_known_args()
 
@@ -902,6 +1055,14 @@ class DZFileTools:
 		print("[+] DZ Partition List\n=========================================")
 		self.dz_file.display()
 
+	def cmdVerify(self, name, checkZeros, workers):
+		print("[+] Verifying {:s} against DZ file\n".format(name))
+		failed = self.dz_file.verify(name, checkZeros, workers)
+		if failed:
+			print("\n[!] {:d} chunks failed verification".format(failed))
+			sys.exit(1)
+		print("\n[+] All chunks verified")
+
 	def cmdExtractChunk(self, files):
 		if len(files) == 0:
 			print("[+] Extracting all chunks!\n")
@@ -921,7 +1082,7 @@ class DZFileTools:
 				print("[!] Cannot extract out of range chunk {:d} (min=0 max={:d})".format(idx, self.dz_file.getChunkCount()-1), file=sys.stderr)
 				sys.exit(1)
 			name = self.dz_file.getChunkName(idx)
-			file = io.FileIO(name, "wb")
+			file = self.hashed(io.FileIO(name, "wb"), name)
 			self.dz_file.extractChunk(file, name, idx)
 			file.close()
 
@@ -944,7 +1105,7 @@ class DZFileTools:
 				print("[!] Cannot extract out of range chunkfile {:d} (min=0 max={:d})".format(idx, self.dz_file.getChunkCount()-1), file=sys.stderr)
 				sys.exit(1)
 			name = self.dz_file.getChunkName(idx) + ".chunk"
-			file = io.open(name, "wb")
+			file = self.hashed(io.open(name, "wb"), name)
 			self.dz_file.extractChunkfile(file, name, idx)
 			file.close()
 
@@ -974,7 +1135,7 @@ class DZFileTools:
 				slice = self.dz_file.getSlice(cur)
 
 			name = slice.getSliceName() + ".image"
-			file = io.FileIO(name, "wb")
+			file = self.hashed(io.FileIO(name, "wb"), name)
 			self.dz_file.extractSlice(file, name, cur)
 			file.close()
 
@@ -987,6 +1148,7 @@ class DZFileTools:
 			file = io.open(name, "r+b")
 		except IOError:
 			file = io.open(name, "wb")
+		file = self.hashed(file, name)
 		self.dz_file.extractImage(file, name)
 		file.close()
 
@@ -998,12 +1160,20 @@ class DZFileTools:
 		if cmd.outdir:
 			self.outdir = cmd.outdir
 
+		# before changing directory
+		if cmd.manifest:
+			self.manifest = manifest.Manifest(cmd.manifest)
+
 		self.dz_file = UNDZFile(cmd.dzfile)
 
 		if cmd.listOnly:
 			self.cmdListPartitions()
 			sys.exit(0)
 
+		if cmd.verifyFile:
+			self.cmdVerify(cmd.verifyFile, cmd.checkZeros, cmd.jobs)
+			sys.exit(0)
+
 		# Ensure that the output directory exists
 		if not os.path.exists(self.outdir):
 			os.makedirs(self.outdir)
@@ -1030,6 +1200,9 @@ class DZFileTools:
 		# Save the header for later reconstruction
 		self.dz_file.saveHeader(cmd.dzfile)
 
+		if self.manifest:
+			self.manifest.close()
+
 if __name__ == "__main__":
 	dztools = DZFileTools()
 	dztools.main()
@@ -20,6 +20,7 @@ Copyright (C) 2013 IOMonster (thecubed on XDA)
 
 from __future__ import print_function
 import os
+import io
 import argparse
 import sys
 from binascii import b2a_hex
@@ -28,108 +29,151 @@ from binascii import b2a_hex
 sys.path.append(os.path.join(sys.path[0], "libexec"))
 
 import kdz
+import copyrange
+import jobs
+import manifest
 
 
-class KDZFileTools(kdz.KDZFile):
+class KDZStream(object):
 	"""
-	LGE KDZ File tools
+	Wrapper for reading a KDZ file from a pipe or other unseekable
+	source.  Everything read is kept while the headers are parsed, so
+	seeks within the header region work; after that only forward
+	seeks are allowed, skipping over the data.
 	"""
 
-	# Setup variables
-	partitions = []
-	outdir = "kdzextracted"
-	infile = None
+	def read(self, count):
+		"""
+		Read up to count bytes
+		"""
+
+		buf = b""
 
-	kdz_header = {
-		b"\x28\x05\x00\x00"b"\x34\x31\x25\x80":	0,
-		b"\x18\x05\x00\x00"b"\x32\x79\x44\x50":	1,
-		kdz.KDZFile._dz_header:			2,
-	}
+		# Replay data from header area after a seek backwards
+		if self.pos < len(self.header):
+			buf = bytes(self.header[self.pos:self.pos + count])
+			self.pos += len(buf)
+			count -= len(buf)
 
+		if count > 0:
+			more = self.file.read(count)
+			if self.saving:
+				self.header += more
+			self.pos += len(more)
+			buf += more
 
-	def readKDZHeader(self):
+		return buf
+
+	def seek(self, offset, whence=os.SEEK_SET):
 		"""
-		Reads the KDZ header, and returns a single kdz_item
-		in the form as defined by self._dz_format_dict
+		Seek within the saved header area, or forwards
 		"""
 
-		# Read a whole DZ header
-		buf = self.infile.read(self._dz_length)
-
-		# "Make the item"
-		# Create a new dict using the keys from the format string
-		# and the format string itself
-		# and apply the format to the buffer
-		kdz_item = dict(zip(
-			self._dz_format_dict.keys(),
-			self._dz_struct.unpack(buf)
-		))
-
-		# Collapse (truncate) each key's value if it's listed as collapsible
-		for key in self._dz_collapsibles:
-			if type(kdz_item[key]) is str or type(kdz_item[key]) is bytes:
-				kdz_item[key] = kdz_item[key].rstrip(b'\x00')
-				if b'\x00' in kdz_item[key]:
-					print("[!] Error: extraneous data found IN "+key, file=sys.stderr)
-					sys.exit(1)
-			elif type(kdz_item[key]) is int:
-				if kdz_item[key] != 0:
-					print('[!] Error: field "'+key+'" is non-zero ('+b2a_hex(kdz_item[key])+')', file=sys.stderr)
-					sys.exit(1)
-			else:
-				print("[!] Error: internal error", file=sys.stderr)
-				sys.exit(-1)
+		if whence == os.SEEK_CUR:
+			offset += self.pos
+		elif whence != os.SEEK_SET:
+			raise IOError("Cannot seek relative to end of a stream")
 
-		return kdz_item
+		if offset < self.pos and (not self.saving or offset < 0):
+			raise IOError("Cannot seek backwards in a stream")
 
-	def getPartitions(self):
+		if offset <= len(self.header):
+			self.pos = offset
+		else:
+			self.pos = max(self.pos, len(self.header))
+			while self.pos < offset:
+				if len(self.read(min(offset - self.pos, copyrange.bufferSize))) == 0:
+					raise IOError("Unexpected end of stream")
+
+		return self.pos
+
+	def tell(self):
 		"""
-		Returns the list of partitions from a KDZ file containing multiple segments
+		Return the current offset
 		"""
+		return self.pos
 
-		# Setup initial values
-		last = False
-		cont = not last
-		self.dataStart = 1<<63
+	def getHeader(self, start, end):
+		"""
+		Return a piece of the saved header area
+		"""
+		return bytes(self.header[start:end])
 
-		while cont:
+	def endHeader(self, end):
+		"""
+		Headers have been parsed, save through offset end, then stop
+		saving everything read
+		"""
+		self.seek(end, os.SEEK_SET)
+		self.saving = False
 
-			# Read the current KDZ header
-			kdz_sub = self.readKDZHeader()
+	def copyTo(self, file, length, consumer=None):
+		"""
+		Copy length bytes from the current position into file, returns
+		the count actually copied (short at end of stream).  If given,
+		consumer(data, offset) is handed each piece of data.
+		"""
 
-			# Add it to our list
-			self.partitions.append(kdz_sub)
+		done = 0
 
-			# Update start of data, if needed
-			if kdz_sub['offset'] < self.dataStart:
-				self.dataStart = kdz_sub['offset']
+		if self.pos < len(self.header):
+			buf = self.read(min(length, len(self.header) - self.pos))
+			file.write(buf)
+			if consumer:
+				consumer(buf, done)
+			done += len(buf)
 
-			# Was it the last one?
-			cont = not last
+		view = memoryview(bytearray(min(copyrange.bufferSize, max(length, 1))))
 
-			# Check for end of headers
-			nextchar = self.infile.read(1)
-			# Is this the last KDZ header? (ctrl-C, how appropos)
-			if nextchar == b'\x03':
-				last = True
-			# Alternative, immediate end
-			elif nextchar == b'\x00':
-				cont = False
-			# Rewind file pointer 1 byte
+		while done < length:
+			# the consumer may hang onto the data, so it gets a fresh buffer
+			if consumer:
+				buf = self.file.read(min(length - done, len(view)))
+				count = len(buf)
+				if count:
+					consumer(buf, done)
 			else:
-				self.infile.seek(-1, os.SEEK_CUR)
+				buf = view
+				count = self.file.readinto(view[:min(length - done, len(view))])
+			if not count:
+				break
+			file.write(buf[:count])
+			self.pos += count
+			done += count
+
+		return done
+
+	def close(self):
+		"""
+		Close the underlying file
+		"""
+		self.file.close()
+
+	def __init__(self, file, name):
+		"""
+		Initialize KDZStream, wrapping the file
+		"""
+
+		super(KDZStream, self).__init__()
+
+		self.file = file
+		self.name = name
+		self.pos = 0
+		self.header = bytearray()
+		self.saving = True
 
-		# Record where headers end
-		self.headerEnd = self.infile.tell()
 
-		# Paranoia check for an updated file format
-		buf = self.infile.read(self.dataStart - self.headerEnd - 1)
-		if len(buf.lstrip(b'\x00')) > 0:
-			print("[!] Warning: Data between headers and payload! (offsets {:d} to {:d})".format(self.headerEnd, self.dataStart), file=sys.stderr)
-			self.hasExtra = True
 
-		# Make partition list
-		return [(x['name'],x['length']) for x in self.partitions]
+class KDZFileTools(kdz.KDZFile):
+	"""
+	LGE KDZ File tools
+	"""
+
+	# Setup variables
+	outdir = "kdzextracted"
+	infile = None
+	stream = False
+	manifest = None
 
 	def extractPartition(self,index):
 		"""
@@ -138,36 +182,96 @@ class KDZFileTools(kdz.KDZFile):
 
 		currentPartition = self.partitions[index]
 
-		# Seek to the beginning of the compressed data in the specified partition
-		self.infile.seek(currentPartition['offset'], os.SEEK_SET)
+		# Ensure that the output directory exists
+		if not os.path.exists(self.outdir):
+			try:
+				os.makedirs(self.outdir)
+			except OSError:
+				# another job may have beaten us to it
+				if not os.path.isdir(self.outdir):
+					raise
+
+		# Open the new file for writing
+		name = currentPartition['name'].decode("utf8")
+		outfile = open(os.path.join(self.outdir, name), 'wb')
+
+		# copyRange() doesn't use the position, except on Python 2
+		# where jobs need their own handle so they don't fight over it
+		if hasattr(os, "pread") or self.kdzfile == "-":
+			infile = self.infile
+		else:
+			infile = open(self.infile.name, "rb")
+
+		# Let the kernel move the data if it can
+		consumer = self.startHash(name)
+		count = copyrange.copyRange(infile, outfile, currentPartition['offset'], 0, currentPartition['length'], consumer)
+
+		if count != currentPartition['length']:
+			print("[!] Error: KDZ file truncated, {:s} is short".format(currentPartition['name'].decode("utf8")), file=sys.stderr)
+			sys.exit(1)
+
+		# Close the files
+		if infile is not self.infile:
+			infile.close()
+		outfile.close()
+
+		self.endHash(name, count)
+
+	def startHash(self, name):
+		"""
+		Begin the manifest entry for the output file name, returns the
+		consumer for the copy (None when no manifest is being made)
+		"""
+
+		if not self.manifest:
+			return None
+
+		self.manifest.start(name, os.path.join(self.outdir, name))
+
+		return lambda buf, offset: self.manifest.update(name, buf, offset)
+
+	def endHash(self, name, size):
+		"""
+		The output file name is complete
+		"""
+
+		if self.manifest:
+			self.manifest.finish(name, size)
+
+	def extractStream(self, indices):
+		"""
+		Extracts the listed partitions in a single pass over the input,
+		in the order they appear, so the input needn't be seekable
+		"""
 
 		# Ensure that the output directory exists
 		if not os.path.exists(self.outdir):
 			os.makedirs(self.outdir)
 
-		# Open the new file for writing
-		outfile = open(os.path.join(self.outdir,currentPartition['name'].decode("utf8")), 'wb')
+		for index in sorted(indices, key=lambda i: self.partitions[i]['offset']):
+			currentPartition = self.partitions[index]
+			name = currentPartition['name'].decode("utf8")
 
-		# Use 1024 byte chunks
-		chunkSize = 1024
+			if currentPartition['offset'] < self.infile.tell():
+				print("[!] Error: {:s} overlaps the previous file, cannot stream".format(name), file=sys.stderr)
+				sys.exit(1)
 
-		# uncomment to prevent runaways
-		#for x in xrange(10):
+			# Skip forward to the payload
+			self.infile.seek(currentPartition['offset'], os.SEEK_SET)
 
-		while True:
+			print("[+] Extracting " + name + " to " + os.path.join(self.outdir, name))
 
-			# Read file in 1024 byte chunks
-			outfile.write(self.infile.read(chunkSize))
+			outfile = open(os.path.join(self.outdir, name), 'wb')
 
-			# If the output file + chunkSize would be larger than the input data
-			if outfile.tell() + chunkSize >= currentPartition['length']:
-				# Change the chunk size to be the difference between the length of the input and the current length of the output
-				outfile.write(self.infile.read(currentPartition['length'] - outfile.tell() ))
-				# Prevent runaways!
-				break
+			count = self.infile.copyTo(outfile, currentPartition['length'], self.startHash(name))
 
-		# Close the file
-		outfile.close()
+			outfile.close()
+
+			self.endHash(name, count)
+
+			if count != currentPartition['length']:
+				print("[!] Error: KDZ stream truncated, {:s} is short".format(name), file=sys.stderr)
+				sys.exit(1)
 
 	def saveExtra(self):
 		"""
@@ -186,19 +290,20 @@ class KDZFileTools(kdz.KDZFile):
 
 		print("[+] Extracting extra data to " + filename)
 
-		self.infile.seek(self.headerEnd, os.SEEK_SET)
-
-		total = self.dataStart - self.headerEnd
-		while total > 0:
-			count = 4096 if 4096 < total else total
+		consumer = self.startHash("kdz_extras.bin")
 
-			buf = self.infile.read(count)
+		if self.stream:
+			buf = self.infile.getHeader(self.headerEnd, self.dataStart)
 			extra.write(buf)
-
-			total -= count
+			if consumer:
+				consumer(buf, 0)
+		else:
+			copyrange.copyRange(self.infile, extra, self.headerEnd, 0, self.dataStart - self.headerEnd, consumer)
 
 		extra.close()
 
+		self.endHash("kdz_extras.bin", self.dataStart - self.headerEnd)
+
 	def saveParams(self):
 		"""
 		Save the parameters for creating a compatible file
@@ -232,28 +337,40 @@ class KDZFileTools(kdz.KDZFile):
 	def parseArgs(self):
 		# Parse arguments
 		parser = argparse.ArgumentParser(description='LG KDZ File Extractor originally by IOMonster')
-		parser.add_argument('-f', '--file', help='KDZ File to read', action='store', required=True, dest='kdzfile')
+		parser.add_argument('-f', '--file', help='KDZ File to read ("-" for stdin)', action='store', required=True, dest='kdzfile')
 		group = parser.add_mutually_exclusive_group(required=True)
 		group.add_argument('-l', '--list', help='list partitions', action='store_true', dest='listOnly')
 		group.add_argument('-x', '--extract', help='extract all partitions', action='store_true', dest='extractAll')
 		group.add_argument('-s', '--single', help='single Extract by ID', action='store', dest='extractID', type=int)
 		parser.add_argument('-d', '--dir', '-o', '--out', help='output directory', action='store', dest='outdir')
+		parser.add_argument('-S', '--stream', help='read input in a single pass (automatic for pipes)', action='store_true', dest='stream')
+		parser.add_argument('-M', '--manifest', help='write SHA-256 manifest of extracted files', action='store', dest='manifest')
+		parser.add_argument('-j', '--jobs', help='number of embedded files to extract concurrently', action='store', dest='jobs', type=int, default=1)
 
 		return parser.parse_args()
 
 	def openFile(self, kdzfile):
 		# Open the file
 		try:
-			self.infile = open(kdzfile, "rb")
+			if kdzfile == "-":
+				self.infile = io.open(sys.stdin.fileno(), "rb", closefd=False)
+			else:
+				self.infile = io.open(kdzfile, "rb")
 		except IOError as err:
 			print(err, file=sys.stderr)
 			sys.exit(1)
 
 		# Get length of whole file
-		self.infile.seek(0, os.SEEK_END)
-		# os.seek() doesn't return current position?!
-		self.kdz_length = self.infile.tell()
-		self.infile.seek(0, os.SEEK_SET)
+		if not self.stream:
+			try:
+				self.kdz_length = self.infile.seek(0, os.SEEK_END)
+				self.infile.seek(0, os.SEEK_SET)
+			except (IOError, OSError):
+				# pipe or similar
+				self.stream = True
+
+		if self.stream:
+			self.infile = KDZStream(self.infile, kdzfile)
 
 		# Verify KDZ header
 		verify_header = self.infile.read(8)
@@ -268,14 +385,21 @@ class KDZFileTools(kdz.KDZFile):
 
 	def cmdExtractSingle(self, partID):
 		print("[+] Extracting single partition from v{:d} file!\n".format(self.header_type))
+		if self.stream:
+			self.extractStream([partID])
+			return
 		print("[+] Extracting " + str(self.partList[partID][0]) + " to " + os.path.join(self.outdir,self.partList[partID][0].decode("utf8")))
 		self.extractPartition(partID)
 
 	def cmdExtractAll(self):
 		print("[+] Extracting all partitions from v{:d} file!\n".format(self.header_type))
-		for part in enumerate(self.partList):
+		def extract(part):
 			print("[+] Extracting " + part[1][0].decode("utf8") + " to " + os.path.join(self.outdir,part[1][0].decode("utf8")))
 			self.extractPartition(part[0])
+		if self.stream:
+			self.extractStream(range(len(self.partList)))
+		else:
+			jobs.runJobs(extract, enumerate(self.partList), self.jobs)
 		self.saveExtra()
 		self.saveParams()
 
@@ -287,12 +411,25 @@ class KDZFileTools(kdz.KDZFile):
 	def main(self):
 		args = self.parseArgs()
 		self.kdzfile = args.kdzfile
+		self.stream = args.stream
 		self.openFile(args.kdzfile)
 		self.partList = self.getPartitions()
 
+		if self.stream:
+			self.infile.endHeader(self.dataStart)
+
 		if args.outdir:
 			self.outdir = args.outdir
 
+		self.jobs = args.jobs
+
+		# standard input can't be reopened, so Python 2 can't share it
+		if self.kdzfile == "-" and not hasattr(os, "pread"):
+			self.jobs = 1
+
+		if args.manifest:
+			self.manifest = manifest.Manifest(args.manifest)
+
 		if args.listOnly:
 			self.cmdListPartitions()
 
@@ -305,6 +442,9 @@ class KDZFileTools(kdz.KDZFile):
 		elif args.extractAll:
 			self.cmdExtractAll()
 
+		if self.manifest:
+			self.manifest.close()
+
 if __name__ == "__main__":
 	kdztools = KDZFileTools()
 	kdztools.main()